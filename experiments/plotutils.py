@@ -1,5 +1,10 @@
+import numpy as np
+import cv2 as cv2
 from skimage.measure import regionprops
 import matplotlib.patches as mpatches
+import matplotlib.collections as mcollections
+
+from src.processing.label_ops import region_stats
 
 def add_regions_annotations(labels, axes, annotator, **kwargs):
     regions = regionprops(labels)
@@ -33,6 +38,124 @@ def label_annotator(axes, region, label, **kwargs):
     txt = "Cell#"+str(label)
     axes.text(y, x, txt, **kwargs)
 
+
+# Batched rendering: geometry of every region is computed once with vectorized label statistics
+# and drawn as a single matplotlib collection, or rasterized in the image array for thumbnails
+
+def regions_geometry(labels):
+    """
+    :param labels: labels ndarray, 0 is background
+    :return: tuple of ids (n,), centroids (n, 2) as (row, col), bboxes (n, 4) as regionprops bbox
+    and equivalent diameters (n,)
+    """
+    regions = region_stats(labels)
+    diameters = np.sqrt(4 * regions.areas / np.pi)
+    return regions.ids, regions.centroids, regions.bboxes, diameters
+
+
+def add_regions_collection(labels, axes, kind="circle", text=False, text_kwargs=None, **kwargs):
+    """
+    Draw every region annotation with a single artist, same shapes of circle_annotator and box_annotator.
+    Regions and "Cell#<i>" numbers are the ones of add_regions_annotations, that skips the first region.
+
+    :param labels: labels ndarray, 0 is background
+    :param axes: matplotlib axes where the image is shown
+    :param kind: "circle" (equivalent diameter circle), "box" (bounding box) or "point" (centroid marker)
+    :param text: if True add "Cell#<i>" labels as label_annotator does (one text artist per region, slow)
+    :param text_kwargs: keyword arguments of axes.text
+    :param kwargs: collection keyword arguments, e.g. facecolors, edgecolors, linewidths, alpha
+    :return: the added collection
+    """
+    ids, centroids, bboxes, diameters = (values[1:] for values in regions_geometry(labels))
+    offsets = centroids[:, ::-1]  # (x, y) image space is (col, row)
+
+    if kind == "circle":
+        kwargs.setdefault("facecolors", "none")
+        collection = mcollections.EllipseCollection(diameters, diameters, np.zeros(len(ids)), units="xy",
+                                                    offsets=offsets, transOffset=axes.transData, **kwargs)
+        axes.add_collection(collection)
+    elif kind == "box":
+        minr, minc, maxr, maxc = bboxes.T
+        vertices = np.stack([np.column_stack(corner) for corner in
+                             ((minc, minr), (maxc, minr), (maxc, maxr), (minc, maxr))], axis=1)
+        kwargs.setdefault("facecolors", "none")
+        collection = mcollections.PolyCollection(vertices, **kwargs)
+        axes.add_collection(collection)
+    elif kind == "point":
+        collection = axes.scatter(offsets[:, 0], offsets[:, 1], **kwargs)
+    else:
+        raise ValueError("unknown annotation kind {}".format(kind))
+
+    if text:
+        for i, (y, x) in enumerate(centroids):
+            axes.text(x, y, "Cell#" + str(i), **(text_kwargs or {}))
+
+    return collection
+
+
+def rasterize_annotations(image, labels, kind="contour", color=(255, 0, 0), thickness=1):
+    """
+    Draw region annotations directly in a copy of the image array, much faster than matplotlib artists,
+    e.g. for thumbnails of whole batches.
+
+    :param image: RGB uint8 image ndarray
+    :param labels: labels ndarray of the image, 0 is background
+    :param kind: "contour" (regions boundaries), "box" (bounding boxes) or "circle" (equivalent diameter circles)
+    :param color: RGB annotation color
+    :param thickness: lines thickness in pixels (box and circle)
+    :return: annotated copy of the image
+    """
+    annotated = np.array(image[..., :3], dtype=np.uint8)
+
+    if kind == "contour":
+        # boundary pixels are the ones with a different 4-neighbour
+        boundary = np.zeros(labels.shape, dtype=bool)
+        boundary[:-1] |= labels[:-1] != labels[1:]
+        boundary[1:] |= labels[1:] != labels[:-1]
+        boundary[:, :-1] |= labels[:, :-1] != labels[:, 1:]
+        boundary[:, 1:] |= labels[:, 1:] != labels[:, :-1]
+        annotated[boundary & (labels != 0)] = color
+        return annotated
+
+    ids, centroids, bboxes, diameters = regions_geometry(labels)
+    color = tuple(int(c) for c in color)
+    if kind == "box":
+        for minr, minc, maxr, maxc in bboxes:
+            cv2.rectangle(annotated, (int(minc), int(minr)), (int(maxc) - 1, int(maxr) - 1), color, thickness)
+    elif kind == "circle":
+        for (row, col), diameter in zip(centroids, diameters):
+            cv2.circle(annotated, (int(round(col)), int(round(row))), int(round(diameter / 2)), color, thickness)
+    else:
+        raise ValueError("unknown annotation kind {}".format(kind))
+
+    return annotated
+
+
+def thumbnails_grid(images, labels_list, ncols=8, max_side=256, kind="contour", color=(255, 0, 0)):
+    """
+    Build a single mosaic image of annotated thumbnails of a batch of fields.
+
+    :param images: list of RGB uint8 images
+    :param labels_list: list of labels ndarray, one for each image
+    :param ncols: number of thumbnails for each mosaic row
+    :param max_side: side of each thumbnail cell of the mosaic
+    :param kind: annotation kind, see rasterize_annotations
+    :param color: RGB annotation color
+    :return: RGB uint8 mosaic ndarray
+    """
+    nrows = int(np.ceil(len(images) / ncols))
+    grid = np.full((nrows * max_side, ncols * max_side, 3), 255, dtype=np.uint8)
+
+    for i, (image, labels) in enumerate(zip(images, labels_list)):
+        annotated = rasterize_annotations(image, labels, kind, color)
+        scale = max_side / max(annotated.shape[:2])
+        thumb = cv2.resize(annotated, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        row, col = divmod(i, ncols)
+        grid[row * max_side:row * max_side + thumb.shape[0], col * max_side:col * max_side + thumb.shape[1]] = thumb
+
+    return grid
+
 """
 nsamples = 100
 x = np.linspace(0, 10, nsamples)
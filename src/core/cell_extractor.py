@@ -6,6 +6,8 @@
 import os
 import time
 import logging
+import argparse
+import multiprocessing
 from datetime import timedelta
 from pathlib import Path
 
@@ -14,13 +16,94 @@ from scipy import ndimage
 import cv2
 from skimage import morphology
 from skimage import io
-from skimage.measure import regionprops
 from skimage.feature import peak_local_max
 from src.core.data_manager import DataManager
+from src.core.detection_cache import DetectionCache
+from src.core.crop_store import CropStoreWriter
+from src.core.profiling import StageProfiler
+from src.core.manifest import Manifest
+from src.core.quality_gate import QualityGate
+from src.core.dedup_index import DedupIndex, find_duplicate
+from src.core.work_queue import WorkQueue
+from src.processing.tiling import tile_grid, open_image_memmap, empty_labels_memmap
+from src.processing.label_ops import region_stats, region_bboxes, filter_by_area
+from src.processing.image_hashing import dhash, digest, pixel_mse
 from collections import namedtuple
 
 LOW_THRESHOLD_SIZE = 1000
 HIGH_THRESHOLD_SIZE = 15000
+MEANSHIFT_SPATIAL_RADIUS = 21
+MEANSHIFT_COLOR_RADIUS = 51
+DILATION_RADIUS = 5
+MIN_DISTANCE = 30
+TILE_OVERLAP = 200  # must be greater than the biggest cell side, see detect_cells_tiled
+LOW_MEMORY_CHUNK_ROWS = 256  # rows relabeled at once by the low memory size filter
+QUEUE_CHUNK_FACTOR = 4  # images claimed at once from a work queue for each worker process
+DEDUP_MAX_MSE = 25.0  # max gray levels mean squared difference of near duplicate fields, see find_duplicate_field
+
+CellCrop = namedtuple("CellCrop", ["index", "label", "bbox", "image"])
+ImageResult = namedtuple("ImageResult", ["infile", "ncells", "error", "stats", "records"])
+
+# extractor instance owned by each worker process of the pool, see _init_worker
+_worker_extractor = None
+
+
+# detect_cells stages, shared with parameter sweeps (see ParameterSweep) that reuse upstream stages results,
+# parameters default to module constants, read at call time
+
+def meanshift_stage(field_image, spatial_radius=None, color_radius=None):
+    spatial_radius = MEANSHIFT_SPATIAL_RADIUS if spatial_radius is None else spatial_radius
+    color_radius = MEANSHIFT_COLOR_RADIUS if color_radius is None else color_radius
+    return cv2.pyrMeanShiftFiltering(field_image, spatial_radius, color_radius)
+
+
+def threshold_stage(shifted, profiler=None):
+    # convert the mean shift image to grayscale, then apply
+    # Otsu's thresholding
+    # gray = cv2.cvtColor(shifted, cv2.COLOR_BGR2GRAY)
+    gray = cv2.cvtColor(shifted, cv2.COLOR_RGB2GRAY)
+    if profiler is not None:
+        profiler.mark("grayscale", gray)
+    binary = cv2.threshold(gray, 0, 255,
+                           cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
+    if profiler is not None:
+        profiler.mark("binary", binary)
+
+    return gray, binary
+
+
+def dilation_stage(binary, radius=None):
+    # morphological transformation
+    selem = morphology.disk(DILATION_RADIUS if radius is None else radius)
+    return morphology.dilation(binary, selem)
+
+
+def distance_stage(dilated):
+    # compute the exact Euclidean distance from every binary
+    # pixel to the nearest zero pixel
+    return ndimage.distance_transform_edt(dilated)
+
+
+def watershed_stage(dist_map, dilated, min_distance=None):
+    # find peaks in the distance map
+    min_distance = MIN_DISTANCE if min_distance is None else min_distance
+    local_max = peak_local_max(dist_map, indices=False, min_distance=min_distance,
+                               labels=dilated)
+
+    # perform a connected component analysis on the local peaks,
+    # using 8-connectivity, then apply the Watershed algorithm
+    markers = ndimage.label(local_max, structure=np.ones((3, 3)))[0]
+    return morphology.watershed(-dist_map, markers, mask=dilated)
+
+
+def size_filter_stage(labels, low_threshold_size=None, high_threshold_size=None, out=None, chunk_rows=None,
+                      compact=False):
+    # Remove labels too small and too big, out, chunk_rows and compact bound the filter memory (see filter_by_area)
+    low_threshold_size = LOW_THRESHOLD_SIZE if low_threshold_size is None else low_threshold_size
+    high_threshold_size = HIGH_THRESHOLD_SIZE if high_threshold_size is None else high_threshold_size
+
+    return filter_by_area(labels, low_threshold_size, high_threshold_size, out=out, chunk_rows=chunk_rows,
+                          compact=compact)
 
 
 class Extractor:
@@ -32,65 +115,101 @@ class Extractor:
     * "prototype mode", using detect_cells and extract_cells method independently from data manager, allows
     to quickly prototyping and experimentation.
     """
-    def __init__(self, data_manager):
+    def __init__(self, data_manager, cache=None, tile_size=None, tile_overlap=TILE_OVERLAP, crop_store=None,
+                 profiler=None, quality_gate=None, dedup=None, low_memory=False):
         """
 
         :param data_manager: an instance of DataManager class
+        :param cache: an instance of DetectionCache class, if None detection results are not cached
+        :param tile_size: if not None images are memory mapped and cells detected in tiles of this side,
+        see detect_cells_tiled
+        :param tile_overlap: margin in pixels shared by adjacent tiles
+        :param crop_store: an instance of CropStoreWriter class, if not None cells are appended to the crop store
+        instead of being saved one image file per cell
+        :param profiler: an instance of StageProfiler class, if not None detection stages cost of every
+        processed image is recorded in it by batch_process
+        :param quality_gate: an instance of QualityGate class, if not None unusable fields are rejected (or flagged)
+        before cells detection
+        :param dedup: an instance of DedupIndex class, if not None fields duplicate of already indexed ones are skipped
+        :param low_memory: if True cells are detected with detect_cells_low_memory
         """
         self.data_manager = data_manager
         self.images = self.data_manager.get_input_images()
+        self.cache = cache
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.crop_store = crop_store
+        self.profiler = profiler
+        self.quality_gate = quality_gate
+        self.dedup = dedup
+        self.low_memory = low_memory
+        # unique fields hashes searched by process_image, a copy of the dedup index tree in worker processes
+        self._dedup_tree = None
+        self._dedup_distance = 0
+
+    def __getstate__(self):
+        # worker processes search duplicates in the dedup tree only, the index SQLite connection can't be pickled
+        state = self.__dict__.copy()
+        state["dedup"] = None
+        return state
 
     @staticmethod
-    def detect_cells(field_image, return_steps=False):
+    def detection_params():
+        """
+        :return: dict of parameters affecting detect_cells result
+        """
+        return {"low_threshold_size": LOW_THRESHOLD_SIZE,
+                "high_threshold_size": HIGH_THRESHOLD_SIZE,
+                "meanshift_spatial_radius": MEANSHIFT_SPATIAL_RADIUS,
+                "meanshift_color_radius": MEANSHIFT_COLOR_RADIUS,
+                "dilation_radius": DILATION_RADIUS,
+                "min_distance": MIN_DISTANCE}
+
+    @staticmethod
+    def detect_cells(field_image, return_steps=False, profiler=None, low_memory=False):
         """
 
         :param field_image: a numpy ndarray instance of a 3 channel RGB image
         :param return_steps: if True a namedtuple ExtractionSteps is filled with images of algorithm step
+        :param profiler: an instance of StageProfiler class, if not None records the cost of each ExtractionSteps stage
+        :param low_memory: if True and return_steps is False, labels are computed with detect_cells_low_memory
         :return: a tuple of labels for each cell detected and namedtuple ExtractionSteps
         """
+        if low_memory and not return_steps:
+            return Extractor.detect_cells_low_memory(field_image, profiler), None
+
         detection_steps = namedtuple("ExtractionSteps", ["input", "meanshift",
                                                           "grayscale", "binary",
                                                           "dilation", "distance",
                                                           "labels", "filtered_labels"
                                                          ])
+        if profiler is not None:
+            profiler.start()
+            profiler.mark("input", field_image)
+
         # perform pyramid mean shift filtering
         # to aid the thresholding step
-        shifted = cv2.pyrMeanShiftFiltering(field_image, 21, 51)
-
-        # convert the mean shift image to grayscale, then apply
-        # Otsu's thresholding
-        # gray = cv2.cvtColor(shifted, cv2.COLOR_BGR2GRAY)
-        gray = cv2.cvtColor(shifted, cv2.COLOR_RGB2GRAY)
-        binary = cv2.threshold(gray, 0, 255,
-                                  cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
-
-        # morphological transformation
-        selem = morphology.disk(5)
-        dilated = morphology.dilation(binary, selem)
-
-        # compute the exact Euclidean distance from every binary
-        # pixel to the nearest zero pixel, then find peaks in this
-        # distance map
-        dist_map = ndimage.distance_transform_edt(dilated)
-        local_max = peak_local_max(dist_map, indices=False, min_distance=30,
-                                   labels=dilated)
-
-        # perform a connected component analysis on the local peaks,
-        # using 8-connectivity, then apply the Watershed algorithm
-        markers = ndimage.label(local_max, structure=np.ones((3, 3)))[0]
-        labels = morphology.watershed(-dist_map, markers, mask=dilated)
-
-        # Remove labels too small and too big
-        filtered_labels = np.copy(labels)
-        component_sizes = np.bincount(labels.ravel())
-
-        too_small = component_sizes < LOW_THRESHOLD_SIZE
-        too_small_mask = too_small[labels]
-        filtered_labels[too_small_mask] = 0
-
-        too_big = component_sizes > HIGH_THRESHOLD_SIZE
-        too_big_mask = too_big[labels]
-        filtered_labels[too_big_mask] = 0
+        shifted = meanshift_stage(field_image)
+        if profiler is not None:
+            profiler.mark("meanshift", shifted)
+
+        gray, binary = threshold_stage(shifted, profiler)
+
+        dilated = dilation_stage(binary)
+        if profiler is not None:
+            profiler.mark("dilation", dilated)
+
+        dist_map = distance_stage(dilated)
+        if profiler is not None:
+            profiler.mark("distance", dist_map)
+
+        labels = watershed_stage(dist_map, dilated)
+        if profiler is not None:
+            profiler.mark("labels", labels)
+
+        filtered_labels = size_filter_stage(labels)
+        if profiler is not None:
+            profiler.mark("filtered_labels", filtered_labels)
 
         steps = None
         if return_steps:
@@ -101,6 +220,115 @@ class Extractor:
 
         return filtered_labels, steps
 
+    @staticmethod
+    def detect_cells_low_memory(field_image, profiler=None):
+        """
+        Same stages of detect_cells with a lower peak memory: intermediate images are released as soon as
+        the next stage doesn't need them, the distance map is float32 and the size filter lookup table
+        is applied in blocks of rows into labels of the smallest sufficient dtype.
+
+        Labels values are the same of detect_cells: distances are square roots of integers, float32 keeps their
+        order and equalities, so peaks and watershed basins don't change.
+
+        :param field_image: a numpy ndarray instance of a 3 channel RGB image
+        :param profiler: an instance of StageProfiler class, if not None records the cost of each stage
+        :return: labels ndarray of unsigned integer dtype, see label_ops.compact_label_dtype
+        """
+        if profiler is not None:
+            profiler.start()
+            profiler.mark("input", field_image)
+
+        shifted = meanshift_stage(field_image)
+        if profiler is not None:
+            profiler.mark("meanshift", shifted)
+
+        gray, binary = threshold_stage(shifted, profiler)
+        del shifted, gray
+
+        dilated = dilation_stage(binary)
+        del binary
+        if profiler is not None:
+            profiler.mark("dilation", dilated)
+
+        # the conversion briefly holds the float64 map too, a smaller peak than the one of a float64 map
+        # in the watershed stage, that also negates its own copy of the map
+        dist_map = distance_stage(dilated).astype(np.float32)
+        if profiler is not None:
+            profiler.mark("distance", dist_map)
+
+        labels = watershed_stage(dist_map, dilated)
+        del dist_map, dilated
+        if profiler is not None:
+            profiler.mark("labels", labels)
+
+        # the compact labels buffer is allocated after the watershed stage peak, so it doesn't raise it,
+        # and it is the only labels image held by following stages (e.g. cells extraction)
+        filtered_labels = size_filter_stage(labels, chunk_rows=LOW_MEMORY_CHUNK_ROWS, compact=True)
+        del labels
+        if profiler is not None:
+            profiler.mark("filtered_labels", filtered_labels)
+
+        return filtered_labels
+
+    @staticmethod
+    def detect_cells_tiled(field_image, tile_size, overlap=TILE_OVERLAP, profiler=None, low_memory=False):
+        """
+        Detect cells in a large image running detect_cells on overlapping tiles,
+        so peak memory depends on tile size rather than on image size.
+
+        Each tile is extended by overlap pixels on every side. A cell detected in an extended tile
+        is kept only if its centroid falls in the tile core, so cells on tile seams are kept exactly once,
+        and since overlap is greater than cells size every kept cell lies entirely in its extended tile
+        and is never split. Note that Otsu threshold is computed per tile.
+
+        :param field_image: a numpy ndarray (or memmap) instance of a 3 channel RGB image
+        :param tile_size: side of tiles
+        :param overlap: margin in pixels shared by adjacent tiles
+        :param profiler: an instance of StageProfiler class, if not None records the cost of each tile stage
+        :param low_memory: if True cells of each tile are detected with detect_cells_low_memory
+        :return: labels memmap of detected cells, backed by an anonymous temporary file
+        """
+        height, width = field_image.shape[:2]
+        labels = empty_labels_memmap((height, width))
+
+        next_label = 1
+        truncated = 0
+        for tile in tile_grid(field_image.shape, tile_size, overlap):
+            minr, minc, maxr, maxc = tile.core
+            ext_minr, ext_minc, ext_maxr, ext_maxc = tile.extended
+
+            tile_image = np.asarray(field_image[ext_minr:ext_maxr, ext_minc:ext_maxc])
+            try:
+                tile_labels, steps = Extractor.detect_cells(tile_image, profiler=profiler, low_memory=low_memory)
+            except ValueError:
+                continue  # e.g. blank tile, same policy of batch processing
+
+            regions = region_stats(tile_labels)
+            for label, bbox, centroid in zip(regions.ids, regions.bboxes, regions.centroids):
+                row = int(centroid[0]) + ext_minr
+                col = int(centroid[1]) + ext_minc
+                if not (minr <= row < maxr and minc <= col < maxc):
+                    continue  # owned by a neighbour tile
+
+                reg_minr, reg_minc, reg_maxr, reg_maxc = (int(coord) for coord in bbox)
+                if ((reg_minr == 0 and ext_minr > 0) or (reg_minc == 0 and ext_minc > 0) or
+                        (reg_maxr == tile_labels.shape[0] and ext_maxr < height) or
+                        (reg_maxc == tile_labels.shape[1] and ext_maxc < width)):
+                    truncated += 1
+
+                target = labels[ext_minr + reg_minr:ext_minr + reg_maxr, ext_minc + reg_minc:ext_minc + reg_maxc]
+                region_mask = tile_labels[reg_minr:reg_maxr, reg_minc:reg_maxc] == label
+                target[region_mask & (target == 0)] = next_label
+                next_label += 1
+
+            del tile_image, tile_labels
+
+        if truncated:
+            logging.warning("{} cells are bigger than tiles overlap and could be truncated, "
+                            "increase overlap".format(truncated))
+
+        return labels
+
     def extract_cells(self, field_image, cell_labels, file_name_prefix, out_path):
         """
         Given a microscope field image, extract each cell described with a label,
@@ -108,18 +336,57 @@ class Extractor:
 
         Every cell image have a 1:1 aspect ratio and each image file name will be saved as:
          <file_name_prefix>_cell#<label_index>_<file_extension>.
+        If the extractor has a crop store, cells are appended to it with the same name and out_path is ignored.
 
         :param field_image: a numpy ndarray instance of a 3 channel RGB image
         :param cell_labels: a numpy ndarray instance of labels describing detected cells
         :param file_name_prefix: image file name's prefix string
         :param out_path: file path where cell images will be saved
+        :return: the number of extracted cells
         """
-        regions = regionprops(cell_labels)
-        export_img_extension = self.data_manager.get_output_extension()
+        ncells = 0
+        for crop in self.crop_cells(field_image, cell_labels):
+            # save the image
+            img_name = self.cell_file_name(file_name_prefix, crop.index)
+            if self.crop_store is not None:
+                self.crop_store.append(crop.image, img_name, file_name_prefix, crop.label, crop.bbox)
+            else:
+                filepath = os.path.join(out_path, img_name)
+                io.imsave(filepath, crop.image)
+            ncells += 1
 
-        for i, region in enumerate(regions):
+            logging.info("extracted cell: {}".format(img_name))
+
+        if self.crop_store is not None:
+            self.crop_store.flush()
+
+        return ncells
+
+    def cell_file_name(self, file_name_prefix, index):
+        """
+        :param file_name_prefix: image file name's prefix string
+        :param index: index of the cell in its field image
+        :return: the cell image file name
+        """
+        return file_name_prefix + "_cell#" + str(index) + self.data_manager.get_output_extension()
+
+    @staticmethod
+    def crop_cells(field_image, cell_labels):
+        """
+        Crop each cell described with a label from a microscope field image, without saving it.
+
+        Every cell crop have a 1:1 aspect ratio and is a view of the field image.
+
+        :param field_image: a numpy ndarray instance of a 3 channel RGB image
+        :param cell_labels: a numpy ndarray instance of labels describing detected cells
+        :return: generator of CellCrop namedtuple
+        """
+        # sorted by label, as regionprops. Only bboxes are needed, computed without copies of (memmap) labels
+        ids, bboxes = region_bboxes(cell_labels)
 
-            minr, minc, maxr, maxc = region.bbox
+        for i, (label, bbox) in enumerate(zip(ids, bboxes)):
+
+            minr, minc, maxr, maxc = (int(coord) for coord in bbox)
 
             # Transform the region to crop from rectangular to square
             x_side = maxc - minc
@@ -133,19 +400,159 @@ class Extractor:
                 minc = minc - 20
                 minr = minr - 20
 
-            cell = field_image[minr:maxr + 20, minc:maxc + 20]  # crop image
+            maxr = min(maxr + 20, field_image.shape[0])
+            maxc = min(maxc + 20, field_image.shape[1])
+            cell = field_image[minr:maxr, minc:maxc]  # crop image
 
-            # save the image
-            img_name = file_name_prefix + "_cell#" + str(i) + export_img_extension
-            filepath = os.path.join(out_path, img_name)
-            io.imsave(filepath, cell)
+            yield CellCrop(index=i, label=int(label), bbox=(minr, minc, maxr, maxc), image=cell)
 
-            logging.info("extracted cell: {}".format(img_name))
+    def detect_cells_cached(self, field_image, profiler=None):
+        """
+        Detect cells using the DetectionCache instance, if any, to reuse previous results.
 
-    def batch_process(self):
+        :param field_image: a numpy ndarray instance of a 3 channel RGB image
+        :param profiler: an instance of StageProfiler class, stages are recorded only when detection is computed
+        :return: a tuple of labels for each cell detected and cache outcome: "hit", "miss" or None if cache is disabled
+        """
+        if self.cache is None:
+            labels, steps = self.detect_cells(field_image, profiler=profiler, low_memory=self.low_memory)
+            return labels, None
+
+        key = DetectionCache.key(field_image, Extractor.detection_params())
+        labels = self.cache.get(key)
+        if labels is not None:
+            return labels, "hit"
+
+        labels, steps = self.detect_cells(field_image, profiler=profiler, low_memory=self.low_memory)
+        self.cache.put(key, labels)
+        return labels, "miss"
+
+    def process_image(self, infile, out_path):
+        """
+        Detect and extract cells from a single microscope field image file.
+
+        :param infile: path of the field image file
+        :param out_path: file path where cell images will be saved
+        :return: a tuple of the number of extracted cells and a dict of processing stats
+        """
+        profiler = StageProfiler(infile) if self.profiler is not None else None
+
+        image = open_image_memmap(infile) if self.tile_size else io.imread(infile)
+        hashes, duplicate = self.find_duplicate_field(infile, image)
+        if duplicate is not None:
+            return 0, {"cache": None, "stages": [], "quality": [], "rejected": False,
+                       "hashes": hashes, "duplicate": duplicate}
+
+        quality, rejected = self.triage(infile, image)
+        if rejected:
+            return 0, {"cache": None, "stages": [], "quality": quality, "rejected": True, "hashes": hashes}
+
+        if self.tile_size:
+            # cache is bypassed, loading cached labels would take memory proportional to image size
+            labels = self.detect_cells_tiled(image, self.tile_size, self.tile_overlap, profiler=profiler,
+                                             low_memory=self.low_memory)
+            cache_outcome = None
+        else:
+            labels, cache_outcome = self.detect_cells_cached(image, profiler=profiler)
+
+        ncells = self.extract_cells(image, labels, Path(infile).stem, out_path)
+        return ncells, {"cache": cache_outcome, "stages": profiler.records if profiler is not None else [],
+                        "quality": quality, "rejected": False, "hashes": hashes}
+
+    def triage(self, infile, field_image):
+        """
+        Check field image quality with the quality gate, before cells detection.
+
+        :param infile: path of the field image file, for logging
+        :param field_image: a numpy ndarray (or memmap) instance of a 3 channel RGB image
+        :return: tuple of failed quality checks reasons list and True if the field must not be processed
+        """
+        if self.quality_gate is None:
+            return [], False
+
+        metrics, reasons = self.quality_gate.check(field_image)
+        rejected = self.quality_gate.rejects(reasons)
+        if reasons:
+            logging.info("{} image {} ({}): contrast {:.1f}, foreground {:.3f}, focus {:.1f}, saturated {:.3f}".format(
+                "rejected" if rejected else "flagged", infile, ", ".join(reasons),
+                metrics.contrast, metrics.foreground, metrics.focus, metrics.saturated))
+
+        return reasons, rejected
+
+    @staticmethod
+    def load_field(infile):
+        # .npy fields are memory mapped, not loaded in memory
+        return np.load(infile, mmap_mode="r") if infile.endswith(".npy") else io.imread(infile)
+
+    def find_duplicate_field(self, infile, field_image):
+        """
+        Hash a field image and search an already indexed field duplicate of it, in the dedup index tree.
+        Fields with the same pixels are duplicates, fields with close hashes are duplicates only if
+        their downsampled copies differ by at most DEDUP_MAX_MSE.
+
+        Hashes are computed where the field is decoded for detection (e.g. in worker processes),
+        the parent process adds them to the dedup index when results come back.
+
+        :param infile: path of the field image file
+        :param field_image: a numpy ndarray (or memmap) instance of a 3 channel RGB image
+        :return: tuple of (dhash, digest) tuple and (canonical field, hamming distance) tuple,
+        or None values without dedup index or duplicate
+        """
+        if self._dedup_tree is None:
+            return None, None
+
+        def same_field(candidate):
+            try:
+                return pixel_mse(field_image, Extractor.load_field(candidate)) <= DEDUP_MAX_MSE
+            except (OSError, ValueError):  # canonical field moved away or unreadable
+                return False
+
+        hashes = (dhash(field_image), digest(field_image))
+        canonical, distance, _ = find_duplicate(self._dedup_tree, hashes[0], hashes[1], self._dedup_distance,
+                                                confirm=same_field, path=str(infile))
+        return hashes, (canonical, distance) if canonical is not None else None
+
+    def _run_job(self, infile, out_path):
+        logging.info("detecting cells in {} image".format(infile))
+        try:
+            ncells, stats = self.process_image(infile, out_path)
+        except ValueError as e:
+            return ImageResult(infile, 0, str(e), {}, [])
+
+        return ImageResult(infile, ncells, None, stats, [])
+
+    def _process_serial(self, chunks, out_path):
+        for chunk in chunks:
+            for infile in chunk:
+                yield self._run_job(infile, out_path)
+
+    def _process_parallel(self, chunks, out_path, workers):
+        # a single pool for every chunk, chunks can be claimed lazily from a work queue
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(self,)) as pool:
+            pending = None
+            for chunk in chunks:
+                # the next chunk is submitted before results of the previous one are consumed,
+                # so workers don't idle at the end of each chunk.
+                # imap keeps input order, so worker logs are replayed in the same order of a serial run
+                submitted = pool.imap(_process_image_job, [(infile, out_path) for infile in chunk])
+                if pending is not None:
+                    yield from pending
+                pending = submitted
+            if pending is not None:
+                yield from pending
+
+    def batch_process(self, workers=1, manifest=None, resume=True, work_queue=None):
         """
         Use a DataManager instance to retrieve information about images paths and for each image retrieved extract cells
         images.
+
+        :param workers: number of worker processes, images are processed serially when 1.
+        If None all available cores are used.
+        :param manifest: an instance of Manifest class, if not None images already processed are skipped
+        and the outcome of each processed image is recorded
+        :param resume: if False images already processed according to the manifest are processed again
+        :param work_queue: an instance of WorkQueue class shared with other nodes, if not None images are claimed from it
+        in chunks, so nodes process disjoint images
         """
         logging.basicConfig(level=logging.INFO, format="[%(asctime)s] - [%(name)s] - [%(levelname)s] - %(message)s")
 
@@ -155,26 +562,243 @@ class Extractor:
         outpath = self.data_manager.get_cells_path()
 
         logging.info("input path: {}".format(inpath))
-        logging.info("extracted cells will be saved in: {}".format(outpath))
+        if self.crop_store is not None:
+            logging.info("extracted cells will be saved in crop store: {}".format(self.crop_store.store_path))
+        else:
+            logging.info("extracted cells will be saved in: {}".format(outpath))
 
         if not self.images:
             logging.error("{} directory is empty! No image to process".format(inpath))
 
-        for i, infile in enumerate(self.images):
-            logging.info("detecting cells in {} image".format(infile))
-
-            image = io.imread(infile)
+        images = self.images
+        if manifest is not None:
+            if resume:
+                images = manifest.pending(self.images)
+                logging.info("manifest: {} images already processed, {} to process".format(
+                    len(self.images) - len(images), len(images)))
+
+        if self.dedup is not None:
+            # in serial runs fields are searched in the index tree itself, so duplicates of fields processed
+            # in this run are skipped too, worker processes search a copy of the tree of previous runs
+            self._dedup_tree = self.dedup.tree("fields")
+            self._dedup_distance = self.dedup.max_distance
+
+        if workers is None:
+            workers = os.cpu_count()
+        workers = max(1, min(workers, len(images)))
+        if workers > 1:
+            logging.info("processing images with {} worker processes".format(workers))
+
+        if work_queue is not None:
+            # every node enqueues the images it selected, images pending or leased by other nodes are left untouched
+            work_queue.enqueue(images)
+            chunks = work_queue.claimed_chunks(workers * QUEUE_CHUNK_FACTOR)
+            logging.info("work queue {}: claiming images as {}".format(work_queue.db_path, work_queue.worker_id))
+        else:
+            if manifest is not None:
+                for infile in images:
+                    manifest.mark_running(infile, commit=False)
+                manifest.commit()
+            chunks = [images]
+
+        nfields = 0
+        ncells = 0
+        cache_outcomes = {"hit": 0, "miss": 0}
+        quality_outcomes = {"rejected": {}, "flagged": {}}
+        if workers > 1:
+            results = self._process_parallel(chunks, outpath, workers)
+        else:
+            results = self._process_serial(chunks, outpath)
+
+        for result in results:
+            for record in result.records:
+                logging.getLogger(record.name).handle(record)
+
+            if result.error is not None:
+                logging.warning("skipped {} image: {}".format(result.infile, result.error))
+                if manifest is not None:
+                    manifest.mark_failed(result.infile, result.error)
+                if work_queue is not None:
+                    work_queue.fail(result.infile, result.error)
+                continue
 
-            try:
-                labels, steps = self.detect_cells(image)
-                self.extract_cells(image, labels, Path(infile).stem, outpath)
-            except ValueError:
+            if result.stats.get("hashes") is not None:
+                duplicate = result.stats.get("duplicate")
+                # duplicates were confirmed where the field was decoded,
+                # processed fields are recorded as aliases only of fields with the same pixels
+                self.dedup.check("fields", result.infile, hashes=result.stats["hashes"], commit=False,
+                                 confirm=(lambda candidate: candidate == duplicate[0]) if duplicate else None)
+                if duplicate is not None:
+                    logging.info("skipped {} image: duplicate of {} (distance {})".format(result.infile, *duplicate))
+                    if manifest is not None:
+                        manifest.mark_done(result.infile, 0, [])
+                    if work_queue is not None:
+                        work_queue.complete(result.infile)
+                    continue
+
+            if manifest is not None:
+                if result.stats.get("rejected"):
+                    manifest.mark_rejected(result.infile, result.stats["quality"])
+                else:
+                    prefix = Path(result.infile).stem
+                    manifest.mark_done(result.infile, result.ncells,
+                                       [self.cell_file_name(prefix, i) for i in range(result.ncells)])
+            if work_queue is not None:
+                # rejected fields stay pending, the next run enqueues them again
+                if result.stats.get("rejected"):
+                    finished = work_queue.release(result.infile, ", ".join(result.stats["quality"]))
+                else:
+                    finished = work_queue.complete(result.infile)
+                if not finished:
+                    logging.warning("lease of {} image expired, it could be processed again by another worker".format(
+                        result.infile))
+
+            outcome = "rejected" if result.stats.get("rejected") else "flagged"
+            for reason in result.stats.get("quality", []):
+                quality_outcomes[outcome][reason] = quality_outcomes[outcome].get(reason, 0) + 1
+            if result.stats.get("rejected"):
                 continue
 
+            nfields += 1
+            ncells += result.ncells
+            if result.stats.get("cache") is not None:
+                cache_outcomes[result.stats["cache"]] += 1
+            if self.profiler is not None:
+                self.profiler.extend(result.stats["stages"])
+
+        if self.crop_store is not None:
+            self.crop_store.close()
+
         end_time = time.monotonic()
-        logging.info("cells extraction time: {}".format(timedelta(seconds=end_time - start_time)))
+        elapsed = end_time - start_time
+        logging.info("cells extraction time: {}".format(timedelta(seconds=elapsed)))
+        if elapsed > 0:
+            logging.info("processed {} fields, {} cells ({:.2f} fields/s, {:.2f} cells/s)".format(
+                nfields, ncells, nfields / elapsed, ncells / elapsed))
+        if self.cache is not None:
+            logging.info("detection cache: {} hits, {} misses".format(cache_outcomes["hit"], cache_outcomes["miss"]))
+        if self.dedup is not None:
+            self.dedup.commit()
+            logging.info(self.dedup.summary("fields"))
+        if self.quality_gate is not None:
+            for outcome, counts in sorted(quality_outcomes.items()):
+                logging.info("quality gate {}: {}".format(outcome, ", ".join(
+                    "{} {}".format(count, reason) for reason, count in sorted(counts.items())) or "none"))
+        if self.profiler is not None:
+            self.profiler.log_summary()
+
+
+class _RecordCollector(logging.Handler):
+    """
+    Logging handler that keeps the records emitted by a worker process, so they can be
+    sent back and logged in order by the parent process.
+    """
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        record.msg = record.getMessage()  # args could be not picklable, freeze the message
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+
+def _init_worker(extractor):
+    global _worker_extractor
+    _worker_extractor = extractor
+
+    cv2.setNumThreads(1)  # parallelism is given by the pool, avoid threads oversubscription
+
+    root = logging.getLogger()
+    root.handlers = [_RecordCollector()]
+    root.setLevel(logging.INFO)
+
+
+def _process_image_job(job):
+    infile, out_path = job
+    collector = logging.getLogger().handlers[0]
+    collector.records = []
+
+    result = _worker_extractor._run_job(infile, out_path)
+    return result._replace(records=collector.records)
+
+
+def setup_parser():
+
+    parser = argparse.ArgumentParser(description="Detect and extract cells from microscope field images")
+
+    parser.add_argument("--config", default="config.ini", help="Configuration file")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes, 0 to use all available cores")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the detection results cache")
+    parser.add_argument("--purge-cache", action="store_true", help="Remove every detection cache entry before processing")
+    parser.add_argument("--cache-size", type=int, default=DetectionCache.DEFAULT_MAX_SIZE // 1024 ** 2,
+                        help="Max detection cache size in MB")
+    parser.add_argument("--export-format", default="png", choices=["png", "store"],
+                        help="Save each cell as an image file or append cells to the packed crop store")
+    parser.add_argument("--tile-size", type=int, default=None,
+                        help="Detect cells in tiles of this side, images are memory mapped (for very large images)")
+    parser.add_argument("--force", action="store_true",
+                        help="Process every image, also the ones already processed according to the manifest")
+    parser.add_argument("--profile", default=None,
+                        help="Export detection stages time and memory to this file (.csv or JSON lines)")
+    parser.add_argument("--tile-overlap", type=int, default=TILE_OVERLAP, help="Margin in pixels shared by adjacent tiles")
+    parser.add_argument("--shard-index", type=int, default=None,
+                        help="Process only images of this shard, overrides [Sharding] of configuration file")
+    parser.add_argument("--shard-count", type=int, default=None, help="Number of shards, see --shard-index")
+    parser.add_argument("--work-queue", action="store_true",
+                        help="Claim images from the work queue shared by every node (work_queue.sqlite in assets)")
+    parser.add_argument("--lease-time", type=int, default=WorkQueue.DEFAULT_LEASE_TIME,
+                        help="Seconds after which images claimed by a crashed node are claimed again")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Skip fields duplicate (perceptual hash) of already indexed fields")
+    parser.add_argument("--dedup-distance", type=int, default=DedupIndex.DEFAULT_MAX_DISTANCE,
+                        help="Max hamming distance between hashes of candidate near duplicate fields, "
+                             "confirmed comparing their pixels")
+    parser.add_argument("--low-memory", action="store_true",
+                        help="Detect cells with compact dtypes and early release of intermediate images")
+    parser.add_argument("--no-quality-gate", action="store_true",
+                        help="Detect cells in every field, without the [Quality] checks of configuration file")
+
+    return parser
 
 
 if __name__ == "__main__":
-    cell_extractor = Extractor(DataManager.from_file())
-    cell_extractor.batch_process()
+    parser = setup_parser()
+    args = parser.parse_args()
+
+    data_manager = DataManager.from_file(args.config)
+    if args.shard_index is not None or args.shard_count is not None:
+        shard_count = args.shard_count if args.shard_count is not None else data_manager.shard_count
+        if args.shard_index is not None and args.shard_count is None and shard_count == 1:
+            parser.error("--shard-index needs --shard-count, or shard_count in [Sharding] of configuration file")
+        data_manager.set_shard(args.shard_index if args.shard_index is not None else data_manager.shard_index,
+                               shard_count)
+
+    cache = DetectionCache(data_manager.get_detection_cache_path(), args.cache_size * 1024 ** 2)
+    if args.purge_cache:
+        cache.purge()
+    if args.no_cache:
+        cache = None
+
+    crop_store = None
+    if args.export_format == "store":
+        crop_store = CropStoreWriter(data_manager.get_crop_store_path())
+
+    cell_extractor = Extractor(data_manager, cache=cache, tile_size=args.tile_size, tile_overlap=args.tile_overlap,
+                               crop_store=crop_store, profiler=StageProfiler() if args.profile else None,
+                               quality_gate=None if args.no_quality_gate else QualityGate.from_file(args.config),
+                               dedup=DedupIndex(data_manager.get_dedup_index_path(), args.dedup_distance)
+                               if args.dedup else None,
+                               low_memory=args.low_memory)
+    manifest = Manifest(data_manager.get_manifest_path(), "extraction")
+    work_queue = None
+    if args.work_queue:
+        work_queue = WorkQueue(data_manager.get_work_queue_path(), "extraction", root=data_manager.get_input_path(),
+                               lease_time=args.lease_time)
+    cell_extractor.batch_process(workers=args.workers or None, manifest=manifest, resume=not args.force,
+                                 work_queue=work_queue)
+
+    if args.profile:
+        cell_extractor.profiler.export(args.profile)
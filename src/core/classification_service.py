@@ -0,0 +1,319 @@
+# ---------------------------------------------------
+# Local classification service: one loaded model shared
+# by many clients, concurrent requests are grouped in
+# micro-batches
+# ---------------------------------------------------
+
+import io
+import json
+import time
+import queue
+import base64
+import logging
+import argparse
+import threading
+import urllib.request
+from collections import deque
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+import numpy as np
+from skimage import io as skimage_io
+from src.core.classifier import Classifier
+from src.core.data_manager import DataManager
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+
+class _Request:
+
+    def __init__(self, batch):
+        self.batch = batch
+        self.created = time.monotonic()
+        self.done = threading.Event()
+        self.classes = None
+        self.probabilities = None
+        self.error = None
+
+
+class MicroBatcher:
+    """
+    Group concurrent classification requests in micro-batches predicted with a single model call.
+
+    A batch is closed when it reaches max_batch_size cells or when max_wait seconds elapsed
+    since its first request was taken. Requests bigger than max_batch_size are split in chunks and a request
+    that would overflow a batch is held back for the next one, so no model call exceeds max_batch_size cells.
+    The model is used only by the batcher thread.
+    """
+
+    def __init__(self, classifier, max_batch_size=Classifier.BATCH_SIZE, max_wait=0.01, latency_window=1000):
+        """
+
+        :param classifier: an instance of Classifier class
+        :param max_batch_size: max number of cells of a micro-batch
+        :param max_wait: max time in seconds a batch waits for other requests
+        :param latency_window: number of recent requests latencies kept for metrics
+        """
+        self.classifier = classifier
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self._queue = queue.Queue()
+        self._held = None  # request that didn't fit in the previous batch, owned by the batcher thread
+        self._latencies = deque(maxlen=latency_window)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        self.cells = 0
+
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._ready = threading.Event()
+        self._load_error = None
+
+    def start(self):
+        """
+        Start the batcher thread and wait until the model is loaded.
+        """
+        self._thread.start()
+        self._ready.wait()
+        if self._load_error is not None:
+            raise self._load_error
+
+    def submit(self, batch):
+        """
+        Classify a batch of pre-processed cells, blocking until the result is available.
+
+        :param batch: ndarray of shape (n, INPUT_IMAGE_WIDTH, INPUT_IMAGE_HEIGHT, 3)
+        :return: tuple of class indices ndarray and probabilities ndarray
+        """
+        requests = [_Request(batch[start:start + self.max_batch_size])
+                    for start in range(0, max(len(batch), 1), self.max_batch_size)]
+        for request in requests:
+            self._queue.put(request)
+
+        for request in requests:
+            request.done.wait()
+            if request.error is not None:
+                raise request.error
+        if len(requests) == 1:
+            return requests[0].classes, requests[0].probabilities
+
+        return (np.concatenate([request.classes for request in requests]),
+                np.concatenate([request.probabilities for request in requests]))
+
+    def _collect(self):
+        if self._held is not None:
+            pending = [self._held]
+            self._held = None
+        else:
+            pending = [self._queue.get()]
+        size = len(pending[0].batch)
+        deadline = time.monotonic() + self.max_wait
+
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if size + len(request.batch) > self.max_batch_size:
+                self._held = request  # first request of the next batch
+                break
+            pending.append(request)
+            size += len(request.batch)
+
+        return pending
+
+    def _run(self):
+        # keras models must be used by the thread (and graph) that loaded them
+        try:
+            self.classifier.model
+        except Exception as e:
+            self._load_error = e
+            return
+        finally:
+            self._ready.set()
+
+        while True:
+            pending = self._collect()
+            try:
+                classes, probabilities = self.classifier.predict_batch(np.concatenate([r.batch for r in pending]))
+            except Exception as e:
+                for request in pending:
+                    request.error = e
+                    request.done.set()
+                continue
+
+            start = 0
+            now = time.monotonic()
+            with self._lock:
+                self.batches += 1
+                for request in pending:
+                    stop = start + len(request.batch)
+                    request.classes = classes[start:stop]
+                    request.probabilities = probabilities[start:stop]
+                    start = stop
+
+                    self.requests += 1
+                    self.cells += len(request.batch)
+                    self._latencies.append(now - request.created)
+                    request.done.set()
+
+    def metrics(self):
+        """
+        :return: dict of service metrics: queue depth, counters and recent requests latency percentiles
+        """
+        with self._lock:
+            latencies = np.asarray(self._latencies)
+            metrics = {"queue_depth": self._queue.qsize(),
+                       "requests": self.requests,
+                       "batches": self.batches,
+                       "cells": self.cells,
+                       "mean_batch_size": self.cells / self.batches if self.batches else 0}
+
+        for percentile in (50, 90, 99):
+            metrics["latency_p{}_ms".format(percentile)] = \
+                float(np.percentile(latencies, percentile) * 1000) if len(latencies) else None
+
+        return metrics
+
+
+def encode_array(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def decode_array(data):
+    return np.load(io.BytesIO(base64.b64decode(data)), allow_pickle=False)
+
+
+class _ServiceHandler(BaseHTTPRequestHandler):
+
+    def _reply(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._reply(200, self.server.batcher.metrics())
+        else:
+            self._reply(404, {"error": "unknown endpoint {}".format(self.path)})
+
+    def do_POST(self):
+        if self.path != "/classify":
+            self._reply(404, {"error": "unknown endpoint {}".format(self.path)})
+            return
+
+        try:
+            content = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode())
+            # pre-processing runs in the request thread, the batcher thread only predicts
+            images = [skimage_io.imread(path) for path in content.get("paths", [])]
+            images += [decode_array(crop) for crop in content.get("crops", [])]
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            self._reply(400, {"error": str(e)})
+            return
+
+        if not images:
+            self._reply(200, {"classes": [], "probabilities": []})
+            return
+
+        try:
+            classes, probabilities = self.server.batcher.submit(Classifier.pre_process_batch(images))
+        except Exception as e:
+            self._reply(500, {"error": str(e)})
+            return
+
+        self._reply(200, {"classes": classes.tolist(), "probabilities": probabilities.tolist()})
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+class ClassificationServer(ThreadingMixIn, HTTPServer):
+    """
+    Localhost HTTP classification service.
+
+    Endpoints:
+    * POST /classify, JSON body with "paths" (cells image files) and/or "crops" (base64 encoded .npy cell images),
+      replies with "classes" and "probabilities" in the same order
+    * GET /metrics, replies with MicroBatcher metrics
+    """
+    daemon_threads = True
+
+    def __init__(self, batcher, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        super().__init__((host, port), _ServiceHandler)
+        self.batcher = batcher
+
+
+class ClassificationClient:
+    """
+    Client of a ClassificationServer instance.
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=60):
+        self.url = "http://{}:{}".format(host, port)
+        self.timeout = timeout
+
+    def _post(self, content):
+        request = urllib.request.Request(self.url + "/classify", data=json.dumps(content).encode(),
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            result = json.loads(response.read().decode())
+        return result["classes"], result["probabilities"]
+
+    def classify_paths(self, paths):
+        """
+        :param paths: list of cells image file paths, readable by the server
+        :return: tuple of class indices list and probabilities list
+        """
+        return self._post({"paths": [str(path) for path in paths]})
+
+    def classify_crops(self, crops):
+        """
+        :param crops: list of cells images ndarray, e.g. from Extractor.crop_cells
+        :return: tuple of class indices list and probabilities list
+        """
+        return self._post({"crops": [encode_array(np.ascontiguousarray(crop)) for crop in crops]})
+
+    def metrics(self):
+        with urllib.request.urlopen(self.url + "/metrics", timeout=self.timeout) as response:
+            return json.loads(response.read().decode())
+
+
+def setup_parser():
+
+    parser = argparse.ArgumentParser(description="Run a local cells classification service")
+
+    parser.add_argument("--config", default="config.ini", help="Configuration file")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="Listening address")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Listening port")
+    parser.add_argument("--max-batch-size", type=int, default=Classifier.BATCH_SIZE,
+                        help="Max number of cells of a micro-batch")
+    parser.add_argument("--max-wait-ms", type=float, default=10,
+                        help="Max time a micro-batch waits for other requests")
+
+    return parser
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] - [%(name)s] - [%(levelname)s] - %(message)s")
+    args = setup_parser().parse_args()
+
+    classifier = Classifier(args.config, DataManager.from_file(args.config))
+    batcher = MicroBatcher(classifier, max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000)
+    batcher.start()
+
+    server = ClassificationServer(batcher, args.host, args.port)
+    logging.info("classification service listening on http://{}:{}".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -1,28 +1,227 @@
 
+import os
+import time
 import shutil
+import queue
+import itertools
+import logging
+import argparse
+import threading
 import configparser
-import skimage
-from skimage import io, transform
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import skimage.io
+import skimage.transform
 from src.core.data_manager import DataManager
-from keras.models import load_model
+from src.core.crop_store import CropStore
+from src.core.manifest import Manifest
+from src.core.results import PredictionStore
+from src.core.tflite_backend import TFLiteModel, export_tflite, compare_models
+from src.core.dedup_index import DedupIndex
+from src.core.work_queue import WorkQueue
+
+# keras is imported when the model is loaded, see Classifier.model, so short invocations don't pay its import time
 
 
 class Classifier:
 
     INPUT_IMAGE_WIDTH = 50
     INPUT_IMAGE_HEIGHT = 50
+    BATCH_SIZE = 64
+    PREFETCH_WORKERS = 4
+    PREFETCH_BATCHES = 2
+    BACKENDS = ("keras", "tflite")
+    CALIBRATION_SAMPLES = 200
 
-    def __init__(self, config_file, data_mngr):
+    def __init__(self, config_file, data_mngr, backend=None, dedup=None, fast_pre_process=False):
 
         config = configparser.ConfigParser()
         config.read(config_file)
 
-        # load the trained model.
-        self.model = load_model(config["Models"]["classifier"])
-        self.model.load_weights(config["Models"]["classifier_weights"])
-        self.model.compile(optimizer='rmsprop', loss='categorical_crossentropy')
+        # the trained model is loaded on first use
+        self._model = None
+        self.model_path = config["Models"]["classifier"]
+        self.weights_path = config["Models"]["classifier_weights"]
+        self.inference_model_path = config["Models"].get("classifier_inference")
+        self.tflite_model_path = config["Models"].get("classifier_tflite")
+        self.backend = backend or config["Models"].get("classifier_backend", "keras")
+        if self.backend not in Classifier.BACKENDS:
+            raise ValueError("unknown classifier backend {}, expected one of {}".format(self.backend,
+                                                                                      Classifier.BACKENDS))
 
         self.data_manager = data_mngr
+        self.dedup = dedup
+        self.reused_predictions = 0
+        self.fast_pre_process = fast_pre_process  # see pre_process_batch
+
+    @property
+    def model(self):
+        """
+        The classification model, loaded at first access.
+
+        With the "tflite" backend the TFLite artifact (see export_tflite_model) is run by the TFLite interpreter,
+        otherwise the keras model is loaded, see load_keras_model.
+        """
+        if self._model is None:
+            start_time = time.monotonic()
+
+            if self.backend == "tflite":
+                if not (self.tflite_model_path and os.path.exists(self.tflite_model_path)):
+                    raise ValueError("tflite backend needs classifier_tflite artifact in configuration file, "
+                                     "generate it with --export-tflite")
+                self._model = TFLiteModel(self.tflite_model_path)
+                source = self.tflite_model_path
+            else:
+                self._model, source = self.load_keras_model()
+
+            logging.info("classifier model {} loaded in {:.2f}s".format(source, time.monotonic() - start_time))
+
+        return self._model
+
+    def load_keras_model(self):
+        """
+        Load the keras model. If the inference model artifact (see export_inference_model) is up to date it is loaded
+        without optimizer state and compile step, otherwise the trained model and its weights are loaded.
+        :return: tuple of keras model and loaded file path
+        """
+        from keras.models import load_model
+
+        if self.inference_model_current():
+            return load_model(self.inference_model_path, compile=False), self.inference_model_path
+        if self.inference_model_path and os.path.exists(self.inference_model_path):
+            logging.warning("inference model {} is older than trained model weights, loading {} instead. "
+                            "Export it again with --export-inference-model".format(self.inference_model_path,
+                                                                                   self.weights_path))
+
+        model = load_model(self.model_path)
+        model.load_weights(self.weights_path)
+        model.compile(optimizer='rmsprop', loss='categorical_crossentropy')
+        return model, self.model_path
+
+    def inference_model_current(self):
+        """
+        :return: True if the inference model artifact exists and it is newer than the trained model and its weights
+        """
+        if not (self.inference_model_path and os.path.exists(self.inference_model_path)):
+            return False
+
+        artifact_time = os.path.getmtime(self.inference_model_path)
+        return all(artifact_time >= os.path.getmtime(path)
+                   for path in (self.model_path, self.weights_path) if os.path.exists(path))
+
+    @property
+    def model_version(self):
+        """
+        Version string of the model, built from the file name and modification time of the loaded model file.
+        """
+        if self.backend == "tflite":
+            model_path = self.tflite_model_path
+        else:
+            model_path = self.inference_model_path if self.inference_model_current() else self.weights_path
+        if not (model_path and os.path.exists(model_path)):
+            model_path = self.weights_path
+        if not (model_path and os.path.exists(model_path)):
+            return "in-memory"
+
+        return "{}@{}".format(os.path.basename(model_path), int(os.path.getmtime(model_path)))
+
+    def export_inference_model(self, out_path=None):
+        """
+        Save the trained model with its weights as an inference only artifact, without optimizer state,
+        that loads faster than the trained model.
+        :param out_path: artifact file path, default is the classifier_inference path of the configuration file
+        """
+        out_path = out_path or self.inference_model_path
+        if not out_path:
+            raise ValueError("no classifier_inference path in configuration file and no out_path given")
+
+        from keras.models import load_model
+        model = load_model(self.model_path)
+        model.load_weights(self.weights_path)
+        model.save(out_path, include_optimizer=False)
+        logging.info("inference model saved in {}".format(out_path))
+
+    def export_tflite_model(self, out_path=None, quantize=False, nsamples=None, store=None):
+        """
+        Convert the trained keras model in a TFLite artifact for the "tflite" backend.
+        :param out_path: artifact file path, default is the classifier_tflite path of the configuration file
+        :param quantize: if True apply int8 post training quantization, calibrated on sample cells images
+        :param nsamples: number of calibration cells images, default CALIBRATION_SAMPLES
+        :param store: an instance of CropStore class, if not None calibration cells are read from it
+        """
+        out_path = out_path or self.tflite_model_path
+        if not out_path:
+            raise ValueError("no classifier_tflite path in configuration file and no out_path given")
+
+        calibration_images = None
+        if quantize:
+            calibration_images = self.sample_images(nsamples or Classifier.CALIBRATION_SAMPLES, store=store)
+            if len(calibration_images) == 0:
+                raise ValueError("no cells images for quantization calibration")
+
+        keras_model, source = self.load_keras_model()
+        export_tflite(keras_model, out_path, calibration_images)
+
+    def parity_check(self, nsamples=None, store=None, batch_size=None):
+        """
+        Compare the TFLite artifact with the keras model on sample cells images: top-1 agreement,
+        max difference of probabilities and throughput of both backends.
+        :param nsamples: number of cells images, default CALIBRATION_SAMPLES
+        :param store: an instance of CropStore class, if not None cells are read from it
+        :param batch_size: number of cells of each model call
+        :return: dict of comparison results, see tflite_backend.compare_models
+        """
+        images = self.sample_images(nsamples or Classifier.CALIBRATION_SAMPLES, store=store, seed=1)
+        keras_model, source = self.load_keras_model()
+        report = compare_models(keras_model, TFLiteModel(self.tflite_model_path), images,
+                                batch_size=batch_size or Classifier.BATCH_SIZE)
+
+        logging.info("parity on {images} cells: agreement {agreement:.2%}, max probability difference "
+                     "{max_probability_difference:.4f}; throughput keras {reference_throughput:.1f} cells/s, "
+                     "tflite {candidate_throughput:.1f} cells/s".format(**report))
+        return report
+
+    def sample_images(self, nsamples, store=None, seed=0):
+        """
+        Pick random cells images and pre-process them in a single batch.
+        :param nsamples: max number of cells images
+        :param store: an instance of CropStore class, if not None cells are read from it, otherwise from cells files
+        :param seed: random generator seed
+        :return: float32 ndarray of shape (n, INPUT_IMAGE_WIDTH, INPUT_IMAGE_HEIGHT, 3)
+        """
+        rng = np.random.RandomState(seed)
+        if store is not None:
+            records = store.records
+            chosen = rng.choice(len(records), min(nsamples, len(records)), replace=False)
+            imgs = [store.get(records[i]) for i in chosen]
+        else:
+            file_names = self.data_manager.get_cells_images()
+            chosen = rng.choice(len(file_names), min(nsamples, len(file_names)), replace=False)
+            imgs = [skimage.io.imread(file_names[i]) for i in chosen]
+
+        return Classifier.pre_process_batch(imgs)
+
+    @classmethod
+    def from_model(cls, model, data_mngr):
+        """
+        Build a Classifier instance around an already loaded keras model.
+        :param model: a keras model with (INPUT_IMAGE_WIDTH, INPUT_IMAGE_HEIGHT, 3) input
+        :param data_mngr: an instance of DataManager class
+        :return: a Classifier instance
+        """
+        classifier = cls.__new__(cls)
+        classifier._model = model
+        classifier.model_path = None
+        classifier.weights_path = None
+        classifier.inference_model_path = None
+        classifier.tflite_model_path = None
+        classifier.backend = "tflite" if isinstance(model, TFLiteModel) else "keras"
+        classifier.data_manager = data_mngr
+        classifier.dedup = None
+        classifier.reused_predictions = 0
+        classifier.fast_pre_process = False
+        return classifier
 
     @staticmethod
     def pre_process_image(img_path):
@@ -32,19 +231,64 @@ class Classifier:
         :return:
         """
         img = skimage.io.imread(img_path)
+
+        return Classifier.pre_process_array(img)
+
+    @staticmethod
+    def pre_process_array(img):
+        """
+        Apply image transformations to adapt an in-memory cell image to model input
+        :param img: a numpy ndarray instance of a 3 channel RGB image
+        :return: ndarray of shape (1, INPUT_IMAGE_WIDTH, INPUT_IMAGE_HEIGHT, 3)
+        """
         img = skimage.img_as_float32(img)
         img = skimage.transform.resize(img, (Classifier.INPUT_IMAGE_WIDTH, Classifier.INPUT_IMAGE_HEIGHT))
 
         return img.reshape((1,) + img.shape)  # add one dimension, needed for keras conv2d input layer
 
-    def load_images(self):
+    @staticmethod
+    def pre_process_batch(imgs, out=None, fast=False):
+        """
+        Adapt many in-memory cell images to model input at once, directly into a float32 batch.
+
+        By default each image is resized with pre_process_array, the transformation the model was trained with.
+        If fast is True images are resized with OpenCV bilinear interpolation, that is several times faster.
+        Its output matches pre_process_array up to interpolation rounding, except on borders of images smaller than
+        model input, where skimage pads with zeros and OpenCV replicates border pixels, and on images much bigger
+        than model input when skimage smooths them before downsampling (anti_aliasing); check classification parity
+        before using it.
+        :param imgs: list of numpy ndarray instances of 3 channel RGB images, e.g. decoded files or cells crops
+        :param out: optional preallocated float32 ndarray of shape (n >= len(imgs), INPUT_IMAGE_WIDTH, INPUT_IMAGE_HEIGHT, 3)
+        :param fast: if True resize images with OpenCV instead of pre_process_array
+        :return: ndarray of shape (len(imgs), INPUT_IMAGE_WIDTH, INPUT_IMAGE_HEIGHT, 3)
+        """
+        if out is None:
+            out = np.empty((len(imgs), Classifier.INPUT_IMAGE_WIDTH, Classifier.INPUT_IMAGE_HEIGHT, 3),
+                           dtype=np.float32)
+
+        dsize = (Classifier.INPUT_IMAGE_HEIGHT, Classifier.INPUT_IMAGE_WIDTH)  # OpenCV size is (columns, rows)
+        for i, img in enumerate(imgs):
+            if fast:
+                img = skimage.img_as_float32(img[..., :3])  # interpolate float values, as pre_process_array
+                out[i] = cv2.resize(img, dsize, interpolation=cv2.INTER_LINEAR)
+            else:
+                out[i] = Classifier.pre_process_array(img[..., :3])[0]
+
+        return out[:len(imgs)]
+
+    def pre_process_batches(self, imgs):
+        return Classifier.pre_process_batch(imgs, fast=self.fast_pre_process)
+
+    def load_images(self, file_names=None):
 
         """
         Utility method to load cells images and apply pre-transformations
+        :param file_names: cells images file names, if None all cells images of the DataManager instance
         :return: list of tuples: (image RGB ndarray, image file name)
         """
 
-        file_names = self.data_manager.get_cells_images()
+        if file_names is None:
+            file_names = self.data_manager.get_cells_images()
         images = [Classifier.pre_process_image(img_name) for img_name in file_names]
 
         return images, file_names
@@ -62,16 +306,339 @@ class Classifier:
 
         return img_class[0]
 
-    def batch_process(self):
+    def predict_batch(self, batch):
+        """
+        Predict classes of a batch of pre-processed cell images with a single model call.
 
-        # load cell images
-        images, file_names = self.load_images()
+        :param batch: ndarray of shape (n, INPUT_IMAGE_WIDTH, INPUT_IMAGE_HEIGHT, 3)
+        :return: tuple of class indices ndarray of shape (n,) and probabilities ndarray of shape (n, classes)
+        """
+        probabilities = self.model.predict(batch, batch_size=len(batch))
 
-        for i, (img, img_name) in enumerate(zip(images, file_names)):
-            cell_class = self.classify(img, img_name)
-            print("Predicted class for image {}: {}".format(img_name, self.data_manager.get_cell_class_path(cell_class)))
+        return Classifier.decide(probabilities), probabilities
+
+    @staticmethod
+    def decide(probabilities):
+        # same decision rule of keras Sequential.predict_classes
+        if probabilities.shape[-1] > 1:
+            return probabilities.argmax(axis=-1)
+
+        return (probabilities > 0.5).astype(np.int32).ravel()
+
+    def predict_batch_deduplicated(self, batch, cell_names):
+        """
+        Predict classes of a batch of pre-processed cell images, reusing predictions of already classified duplicate
+        cells (see DedupIndex) made by the same model version, only the other cells are passed to the model.
+        Near duplicates are not confirmed for cells, so only cells with the same pre-processed pixels are duplicates.
+        Without dedup index it is the same of predict_batch.
+
+        :param batch: ndarray of shape (n, INPUT_IMAGE_WIDTH, INPUT_IMAGE_HEIGHT, 3)
+        :param cell_names: list of n cells names
+        :return: tuple of class indices ndarray of shape (n,) and probabilities ndarray of shape (n, classes)
+        """
+        if self.dedup is None:
+            return self.predict_batch(batch)
+
+        model_version = self.model_version
+        probabilities = [None] * len(batch)
+        for i, cell_name in enumerate(cell_names):
+            canonical, distance = self.dedup.check("cells", cell_name, batch[i], commit=False)
+            value = self.dedup.value("cells", canonical) if canonical is not None else None
+            if value is not None and value["model_version"] == model_version:
+                probabilities[i] = np.asarray(value["probabilities"], dtype=np.float32)
+                self.reused_predictions += 1
+
+        to_predict = [i for i, probs in enumerate(probabilities) if probs is None]
+        if to_predict:
+            classes, predicted = self.predict_batch(batch[to_predict])
+            for i, probs in zip(to_predict, predicted):
+                probabilities[i] = probs
+                self.dedup.set_value("cells", cell_names[i], {"model_version": model_version,
+                                                              "probabilities": probs.tolist()}, commit=False)
+        self.dedup.commit()
+
+        probabilities = np.stack(probabilities)
+        return Classifier.decide(probabilities), probabilities
+
+    def log_dedup_summary(self):
+        if self.dedup is not None:
+            logging.info("{}, {} predictions reused".format(self.dedup.summary("cells"), self.reused_predictions))
+
+    @staticmethod
+    def iter_batches(images, file_names, batch_size):
+        """
+        Group pre-processed images in batches stacking them in a single ndarray.
+
+        :param images: list of pre-processed images, each one of shape (1, INPUT_IMAGE_WIDTH, INPUT_IMAGE_HEIGHT, 3)
+        :param file_names: list of images file names
+        :param batch_size: max number of images for each batch
+        :return: generator of tuples (batch ndarray, batch file names)
+        """
+        for start in range(0, len(images), batch_size):
+            stop = start + batch_size
+            yield np.concatenate(images[start:stop]), file_names[start:stop]
+
+    @staticmethod
+    def prefetch_batches(items, loader, batch_size, workers=None, prefetch=None, pre_process=None):
+        """
+        Load and pre-process images in batches ahead of the model.
+
+        Images are loaded by a thread pool and ready batches wait in a bounded queue, so memory
+        doesn't depend on the number of images and loading overlaps with inference.
+
+        :param items: list or iterable of images to load, e.g. file names or crop store records
+        :param loader: function from an item to a pre-processed image of shape (1, INPUT_IMAGE_WIDTH, INPUT_IMAGE_HEIGHT, 3),
+        or to a raw image if pre_process is given
+        :param batch_size: max number of images for each batch
+        :param workers: number of loading threads, default is PREFETCH_WORKERS
+        :param prefetch: max number of batches loaded ahead, default is PREFETCH_BATCHES
+        :param pre_process: function from a list of raw images to a batch ndarray, e.g. pre_process_batch
+        :return: generator of tuples (batch ndarray, batch items)
+        """
+        batches = queue.Queue(maxsize=prefetch or Classifier.PREFETCH_BATCHES)
+        stop = threading.Event()
+        end = object()
+
+        def put(entry):
+            while not stop.is_set():
+                try:
+                    batches.put(entry, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False  # consumer is gone
+
+        def produce():
+            try:
+                with ThreadPoolExecutor(workers or Classifier.PREFETCH_WORKERS) as executor:
+                    iterator = iter(items)  # items could be a lazy iterable, e.g. WorkQueue.iter_claimed
+                    while True:
+                        chunk = list(itertools.islice(iterator, batch_size))
+                        if not chunk:
+                            break
+                        loaded = list(executor.map(loader, chunk))
+                        batch = pre_process(loaded) if pre_process is not None else np.concatenate(loaded)
+                        if not put((batch, chunk)):
+                            return
+            except Exception as e:
+                put(e)
+                return
+            put(end)
+
+        producer = threading.Thread(target=produce, name="batches-prefetch", daemon=True)
+        producer.start()
+        try:
+            while True:
+                entry = batches.get()
+                if entry is end:
+                    return
+                if isinstance(entry, Exception):
+                    raise entry
+                yield entry
+        finally:
+            stop.set()
+
+    def batch_process(self, batch_size=None, manifest=None, results=None, work_queue=None):
+        """
+        Classify every cell image retrieved with the DataManager instance and move it
+        in its class directory, or store its prediction in a results table.
+
+        :param batch_size: number of images classified by each model call, default is BATCH_SIZE.
+        If 1 images are classified one by one with classify method
+        :param manifest: an instance of Manifest class, if not None cells already classified are skipped
+        and the predicted class of each cell is recorded
+        :param results: an instance of PredictionStore class, if not None predictions are appended to it in bulk
+        and cells images are left in place, see PredictionStore.materialize
+        :param work_queue: an instance of WorkQueue class shared with other nodes, if not None cells images are
+        claimed from it while loading, so nodes classify disjoint cells
+
+        With a dedup index, predictions of duplicate cells are reused except when batch_size is 1.
+        """
+        batch_size = batch_size or Classifier.BATCH_SIZE
+
+        file_names = self.data_manager.get_cells_images()
+        if manifest is not None:
+            file_names = manifest.pending(file_names)
+        if work_queue is not None:
+            work_queue.enqueue(file_names)
+            file_names = work_queue.iter_claimed(batch_size)
+
+        # load cell images ahead of the model
+        batches = Classifier.prefetch_batches(file_names, skimage.io.imread, batch_size,
+                                              pre_process=self.pre_process_batches)
+
+        if batch_size == 1 and results is None:
+            for img, (img_name,) in batches:
+                cell_class = self.classify(img, img_name)
+                print("Predicted class for image {}: {}".format(img_name, self.data_manager.get_cell_class_path(cell_class)))
+                if manifest is not None:
+                    manifest.mark_done(img_name, cells={"class": int(cell_class)})
+                if work_queue is not None:
+                    work_queue.complete(img_name)
+            return
+
+        model_version = self.model_version if results is not None else None
+        for batch, batch_names in batches:
+            classes, probabilities = self.predict_batch_deduplicated(batch, batch_names)
+
+            if results is not None:
+                results.append([(img_name, PredictionStore.source_of(img_name), None, cell_class, probs)
+                                for img_name, cell_class, probs in zip(batch_names, classes, probabilities)],
+                               model_version)
+
+            for img_name, cell_class in zip(batch_names, classes):
+                class_path = self.data_manager.get_cell_class_path(cell_class)
+                if results is None:
+                    shutil.move(img_name, class_path)
+                print("Predicted class for image {}: {}".format(img_name, class_path))
+                if manifest is not None:
+                    manifest.mark_done(img_name, cells={"class": int(cell_class)}, commit=False)
+                if work_queue is not None:
+                    work_queue.complete(img_name)
+
+            if manifest is not None:
+                manifest.commit()
+
+        self.log_dedup_summary()
+
+    def classify_store(self, store, batch_size=None, manifest=None, results=None, work_queue=None):
+        """
+        Classify every cell of a crop store, crops are left in the store.
+
+        :param store: an instance of CropStore class
+        :param batch_size: number of images classified by each model call, default is BATCH_SIZE
+        :param manifest: an instance of Manifest class, if not None cells already classified are skipped
+        and the predicted class of each cell is recorded
+        :param results: an instance of PredictionStore class, if not None predictions are appended to it in bulk
+        :param work_queue: an instance of WorkQueue class shared with other nodes, if not None cells are
+        claimed from it while loading, so nodes classify disjoint cells
+        :return: list of tuples (cell name, class index)
+        """
+        batch_size = batch_size or Classifier.BATCH_SIZE
+
+        records = [record for record in store.records if self.data_manager.in_shard(record.cell_name)]
+        if manifest is not None:
+            records = [record for record in records if not manifest.is_done(record.cell_name)]
+        if work_queue is not None:
+            records_by_name = {record.cell_name: record for record in records}
+            work_queue.enqueue(records_by_name)
+            records = (records_by_name[cell_name] for cell_name in work_queue.iter_claimed(batch_size)
+                       if cell_name in records_by_name)
+
+        model_version = self.model_version if results is not None else None
+        predictions = []
+        for batch, batch_records in Classifier.prefetch_batches(records, store.get, batch_size,
+                                                                pre_process=self.pre_process_batches):
+            classes, probabilities = self.predict_batch_deduplicated(batch, [record.cell_name
+                                                                             for record in batch_records])
+
+            if results is not None:
+                results.append([(record.cell_name, record.source, record.bbox, cell_class, probs)
+                                for record, cell_class, probs in zip(batch_records, classes, probabilities)],
+                               model_version)
+
+            for cell_name, cell_class in zip([record.cell_name for record in batch_records], classes):
+                predictions.append((cell_name, int(cell_class)))
+                print("Predicted class for cell {}: {}".format(cell_name, self.data_manager.get_cell_class_path(cell_class)))
+                if manifest is not None:
+                    manifest.mark_done(cell_name, cells={"class": int(cell_class)}, commit=False)
+                if work_queue is not None:
+                    work_queue.complete(cell_name)
+
+            if manifest is not None:
+                manifest.commit()
+
+        self.log_dedup_summary()
+        return predictions
+
+
+def setup_parser():
+
+    parser = argparse.ArgumentParser(description="Classify extracted cells images")
+
+    parser.add_argument("--config", default="config.ini", help="Configuration file")
+    parser.add_argument("--batch-size", type=int, default=Classifier.BATCH_SIZE,
+                        help="Number of cells classified by each model call")
+    parser.add_argument("--fast-pre-process", action="store_true",
+                        help="Resize cells with OpenCV, faster but not identical to the training transformation")
+    parser.add_argument("--from-store", action="store_true",
+                        help="Classify cells of the packed crop store instead of cells image files")
+    parser.add_argument("--output", default="move", choices=["move", "table"],
+                        help="Move each cell in its class directory or store predictions in the results table")
+    parser.add_argument("--force", action="store_true",
+                        help="Classify every cell, also the ones already classified according to the manifest")
+    parser.add_argument("--materialize", default=None, choices=["hardlink", "symlink", "copy"],
+                        help="Build class directories from the results table and exit")
+    parser.add_argument("--export-inference-model", action="store_true",
+                        help="Save the inference only model artifact (classifier_inference in configuration file) and exit")
+    parser.add_argument("--backend", default=None, choices=Classifier.BACKENDS,
+                        help="Inference backend, default is classifier_backend of configuration file or keras")
+    parser.add_argument("--export-tflite", action="store_true",
+                        help="Save the TFLite model artifact (classifier_tflite in configuration file) and exit")
+    parser.add_argument("--quantize", action="store_true",
+                        help="With --export-tflite, apply int8 quantization calibrated on sample cells")
+    parser.add_argument("--parity-check", action="store_true",
+                        help="Compare accuracy and throughput of TFLite artifact and keras model on sample cells and exit")
+    parser.add_argument("--shard-index", type=int, default=None,
+                        help="Classify only cells of this shard, overrides [Sharding] of configuration file")
+    parser.add_argument("--shard-count", type=int, default=None, help="Number of shards, see --shard-index")
+    parser.add_argument("--work-queue", action="store_true",
+                        help="Claim cells from the work queue shared by every node (work_queue.sqlite in assets)")
+    parser.add_argument("--lease-time", type=int, default=WorkQueue.DEFAULT_LEASE_TIME,
+                        help="Seconds after which cells claimed by a crashed node are claimed again")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Reuse predictions of already classified duplicate cells, with the same pixels")
+    parser.add_argument("--samples", type=int, default=Classifier.CALIBRATION_SAMPLES,
+                        help="Number of sample cells for quantization calibration and parity check")
+
+    return parser
 
 
 if __name__ == "__main__":
-    classifier = Classifier("config.ini", DataManager.from_file())
-    classifier.batch_process()
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] - [%(name)s] - [%(levelname)s] - %(message)s")
+    parser = setup_parser()
+    args = parser.parse_args()
+
+    data_manager = DataManager.from_file(args.config)
+    if args.shard_index is not None or args.shard_count is not None:
+        shard_count = args.shard_count if args.shard_count is not None else data_manager.shard_count
+        if args.shard_index is not None and args.shard_count is None and shard_count == 1:
+            parser.error("--shard-index needs --shard-count, or shard_count in [Sharding] of configuration file")
+        data_manager.set_shard(args.shard_index if args.shard_index is not None else data_manager.shard_index,
+                               shard_count)
+    dedup = DedupIndex(data_manager.get_dedup_index_path()) if args.dedup else None
+    classifier = Classifier(args.config, data_manager, backend=args.backend, dedup=dedup,
+                            fast_pre_process=args.fast_pre_process)
+    if args.export_inference_model:
+        classifier.export_inference_model()
+        raise SystemExit(0)
+
+    if args.export_tflite or args.parity_check:
+        store = CropStore(data_manager.get_crop_store_path()) if args.from_store else None
+        if args.export_tflite:
+            classifier.export_tflite_model(quantize=args.quantize, nsamples=args.samples, store=store)
+        if args.parity_check:
+            classifier.parity_check(nsamples=args.samples, store=store, batch_size=args.batch_size)
+        raise SystemExit(0)
+
+    if args.materialize:
+        store = CropStore(data_manager.get_crop_store_path()) if args.from_store else None
+        PredictionStore(data_manager.get_results_path()).materialize(data_manager, args.materialize, store=store)
+        raise SystemExit(0)
+
+    results = PredictionStore(data_manager.get_results_path()) if args.output == "table" else None
+    # moved cells leave the input directory, in table mode cells stay and are classified again by a new model
+    stage = "classification" if results is None else "classification@{}".format(classifier.model_version)
+    manifest = None if args.force else Manifest(data_manager.get_manifest_path(), stage)
+    work_queue = None
+    if args.work_queue:
+        # files are queued relative to the cells path, crop store cells by name
+        work_queue = WorkQueue(data_manager.get_work_queue_path(), stage,
+                               root=None if args.from_store else data_manager.get_cells_path(),
+                               lease_time=args.lease_time)
+    if args.from_store:
+        classifier.classify_store(CropStore(data_manager.get_crop_store_path()), batch_size=args.batch_size,
+                                  manifest=manifest, results=results, work_queue=work_queue)
+    else:
+        classifier.batch_process(batch_size=args.batch_size, manifest=manifest, results=results,
+                                 work_queue=work_queue)
@@ -0,0 +1,155 @@
+# ---------------------------------------------------
+# Packed storage of cells crops: crops are appended to
+# large shard files described by an index, instead of
+# saving one image file per cell
+# ---------------------------------------------------
+
+import os
+import json
+import uuid
+from pathlib import Path
+from collections import namedtuple
+
+import numpy as np
+
+CropRecord = namedtuple("CropRecord", ["cell_name", "source", "label", "bbox",
+                                       "shard", "offset", "shape", "dtype"])
+
+
+class CropStoreWriter:
+    """
+    Append cells crops to shard files of a crop store directory.
+
+    Each writer process owns its shards (named after a random writer id and the process id),
+    so several extraction processes can write to the same store concurrently.
+    Every shard is a raw binary file paired with a JSON lines index file describing each crop.
+    """
+
+    DEFAULT_SHARD_SIZE = 256 * 1024 ** 2
+
+    def __init__(self, store_path, shard_size=DEFAULT_SHARD_SIZE):
+        """
+
+        :param store_path: directory of the crop store
+        :param shard_size: size in bytes after that a new shard is started
+        """
+        self.store_path = Path(store_path)
+        self.shard_size = shard_size
+
+        self._pid = None
+        self._writer_id = None
+        self._shard_index = 0
+        self._data_file = None
+        self._index_file = None
+
+    def __getstate__(self):
+        # open files are never shared among processes, each one opens its own shards
+        state = self.__dict__.copy()
+        state.update(_pid=None, _data_file=None, _index_file=None)
+        return state
+
+    def _shard_name(self):
+        return "{}-{}-{:05d}".format(self._writer_id, self._pid, self._shard_index)
+
+    def _open_shard(self):
+        self.close()
+        self.store_path.mkdir(parents=True, exist_ok=True)
+
+        if self._pid != os.getpid():  # first use or forked process
+            self._pid = os.getpid()
+            self._writer_id = uuid.uuid4().hex[:8]
+            self._shard_index = 0
+        else:
+            self._shard_index += 1
+
+        name = self._shard_name()
+        self._data_file = (self.store_path / (name + ".bin")).open("ab")
+        self._index_file = (self.store_path / (name + ".index.jsonl")).open("a")
+
+    def append(self, crop_image, cell_name, source, label, bbox):
+        """
+        Append a cell crop to the current shard.
+
+        :param crop_image: ndarray of the cell image
+        :param cell_name: unique name of the cell
+        :param source: path of the field image the cell is cropped from
+        :param label: label id of the cell in the field labels image
+        :param bbox: crop box in the field image (min row, min col, max row, max col)
+        """
+        if self._data_file is None or self._pid != os.getpid() or self._data_file.tell() >= self.shard_size:
+            self._open_shard()
+
+        crop_image = np.ascontiguousarray(crop_image)
+        offset = self._data_file.tell()
+        self._data_file.write(crop_image.data)
+
+        record = CropRecord(cell_name=cell_name, source=str(source), label=int(label),
+                            bbox=[int(x) for x in bbox], shard=self._shard_name() + ".bin",
+                            offset=offset, shape=list(crop_image.shape), dtype=str(crop_image.dtype))
+        self._index_file.write(json.dumps(record._asdict()) + "\n")
+
+    def flush(self):
+        """
+        Flush shard data and index, crops appended so far become visible to readers.
+        """
+        if self._data_file is not None:
+            self._data_file.flush()
+            self._index_file.flush()
+
+    def close(self):
+        if self._data_file is not None:
+            self._data_file.close()
+            self._index_file.close()
+            self._data_file = None
+            self._index_file = None
+
+
+class CropStore:
+    """
+    Read cells crops from a crop store directory.
+
+    Shards are memory mapped and crops returned as views of the mapping, so no data is copied
+    and no image is decoded; only the index files are listed.
+    """
+
+    def __init__(self, store_path):
+        """
+
+        :param store_path: directory of the crop store
+        """
+        self.store_path = Path(store_path)
+        self.records = []
+        self._shards = {}
+
+        for index_path in sorted(self.store_path.glob("*.index.jsonl")):
+            with index_path.open() as index_file:
+                for line in index_file:
+                    try:
+                        self.records.append(CropRecord(**json.loads(line)))
+                    except ValueError:  # blank or truncated line of an interrupted writer
+                        continue
+
+    def __len__(self):
+        return len(self.records)
+
+    def _shard(self, name):
+        if name not in self._shards:
+            self._shards[name] = np.memmap(str(self.store_path / name), dtype=np.uint8, mode="r")
+        return self._shards[name]
+
+    def get(self, record):
+        """
+        :param record: a CropRecord namedtuple of this store
+        :return: read only ndarray view of the cell crop
+        """
+        dtype = np.dtype(record.dtype)
+        nbytes = int(np.prod(record.shape)) * dtype.itemsize
+        data = self._shard(record.shard)[record.offset:record.offset + nbytes]
+        return data.view(dtype).reshape(record.shape)
+
+    def __iter__(self):
+        """
+        :return: generator of tuples (CropRecord namedtuple, cell crop ndarray)
+        """
+        for record in self.records:
+            yield record, self.get(record)
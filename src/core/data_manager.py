@@ -1,3 +1,4 @@
+import zlib
 import configparser
 from pathlib import Path
 
@@ -33,6 +34,10 @@ class DataManager:
 
         self.classes_path = [self.out_path / class_name for class_name in self._classes.values()]
 
+        # this node processes only files of its shard, see set_shard
+        self.shard_index = 0
+        self.shard_count = 1
+
     @classmethod
     def from_file(cls, config_file="config.ini"):
         """
@@ -51,8 +56,32 @@ class DataManager:
         data_manager._allowed_input_extensions = config["Misc"]["input_img_extensions"].split(";")
         data_manager._allowed_output_extensions = config["Misc"]["export_img_extension"].split(";")
 
+        if config.has_section("Sharding"):
+            data_manager.set_shard(config["Sharding"].getint("shard_index", fallback=0),
+                                   config["Sharding"].getint("shard_count", fallback=1))
+
         return data_manager
 
+    def set_shard(self, shard_index, shard_count):
+        """
+        Restrict input and cells images to a deterministic shard, so nodes sharing the same dataset
+        with different shard_index process disjoint files.
+
+        A file belongs to the shard of the hash of its name, so shards don't depend on listing order
+        or on the mount point of the dataset, and new files don't move old ones to other shards.
+        :param shard_index: index of this node shard, in [0, shard_count)
+        :param shard_count: number of shards
+        """
+        if not 0 <= shard_index < shard_count:
+            raise ValueError("shard index {} out of range [0, {})".format(shard_index, shard_count))
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+
+    def in_shard(self, file_path):
+        if self.shard_count == 1:
+            return True
+        return zlib.crc32(Path(file_path).name.encode()) % self.shard_count == self.shard_index
+
     @staticmethod
     def get_file_by_extensions(path, allowed_extensions):
         files = []
@@ -61,10 +90,12 @@ class DataManager:
         return files
 
     def get_input_images(self):
-        return DataManager.get_file_by_extensions(self.input_path, self._allowed_input_extensions)
+        images = DataManager.get_file_by_extensions(self.input_path, self._allowed_input_extensions)
+        return [image for image in images if self.in_shard(image)]
 
     def get_cells_images(self):
-        return DataManager.get_file_by_extensions(self.cells_path, self._allowed_input_extensions)
+        images = DataManager.get_file_by_extensions(self.cells_path, self._allowed_input_extensions)
+        return [image for image in images if self.in_shard(image)]
 
     def get_output_extension(self):
         return self._allowed_output_extensions[0]
@@ -81,5 +112,26 @@ class DataManager:
     def get_output_path(self):
         return str(self.out_path)
 
+    def get_results_path(self):
+        return str(self.assets_path / "predictions.sqlite")
+
+    def get_manifest_path(self):
+        return str(self.assets_path / "manifest.sqlite")
+
+    def get_crop_store_path(self):
+        return str(self.assets_path / "cells_store")
+
+    def get_detection_cache_path(self):
+        return str(self.assets_path / "cache" / "detection")
+
+    def get_work_queue_path(self):
+        return str(self.assets_path / "work_queue.sqlite")
+
+    def get_dedup_index_path(self):
+        return str(self.assets_path / "dedup.sqlite")
+
+    def get_binarization_cache_path(self):
+        return str(self.assets_path / "cache" / "binarization")
+
     def get_cell_class_path(self, class_index):
         return str(self.out_path / self._classes[class_index])
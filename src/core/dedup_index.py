@@ -0,0 +1,243 @@
+# ---------------------------------------------------
+# Persistent perceptual hash index of field images
+# and cells crops, finds exact and near duplicates
+# ---------------------------------------------------
+
+import json
+import time
+import sqlite3
+
+from src.processing.image_hashing import dhash, digest, hamming
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree of hashes in Hamming space: each child edge is labeled with its distance from the parent,
+    so by triangle inequality a search within max_distance visits only children with edge in
+    [d - max_distance, d + max_distance], where d is the query distance from the node.
+    """
+
+    def __init__(self):
+        self._root = None
+        self.size = 0
+
+    def add(self, image_hash, item):
+        self.size += 1
+        node = [image_hash, item, {}]
+        if self._root is None:
+            self._root = node
+            return
+
+        current = self._root
+        while True:
+            distance = hamming(image_hash, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, image_hash, max_distance):
+        """
+        :param image_hash: query hash
+        :param max_distance: max Hamming distance of results
+        :return: list of (distance, item) tuples, sorted by distance
+        """
+        if self._root is None:
+            return []
+
+        results = []
+        candidates = [self._root]
+        while candidates:
+            node_hash, item, children = candidates.pop()
+            distance = hamming(image_hash, node_hash)
+            if distance <= max_distance:
+                results.append((distance, item))
+            candidates.extend(child for edge, child in children.items()
+                              if distance - max_distance <= edge <= distance + max_distance)
+
+        return sorted(results, key=lambda result: result[0])
+
+
+def find_duplicate(tree, image_hash, image_digest, max_distance, confirm=None, path=None):
+    """
+    Search the nearest confirmed duplicate of an image among the canonical images of a BK-tree,
+    e.g. a copy of DedupIndex.tree sent to a worker process.
+
+    :param tree: BKTree instance of (path, digest) items
+    :param image_hash: dhash of the image
+    :param image_digest: digest of the image
+    :param max_distance: max Hamming distance of candidates
+    :param confirm: optional function of a candidate canonical image path, returning True if the image is
+    a near duplicate of it. If None only images with the same pixels are duplicates
+    :param path: image identifier, excluded from candidates. An image already indexed as unique with the same
+    digest keeps its outcome, like DedupIndex.check
+    :return: tuple of canonical image path (None if not found), Hamming distance and True if the images are equal
+    """
+    candidates = tree.search(image_hash, max_distance)
+    if (path, image_digest) in (item for _, item in candidates):
+        return None, 0, False
+
+    for distance, (candidate, candidate_digest) in candidates:
+        if candidate == path:  # indexed with a different image, see DedupIndex.check
+            continue
+        if candidate_digest == image_digest:
+            return candidate, distance, True
+        if confirm is not None and confirm(candidate):
+            return candidate, distance, False
+
+    return None, 0, False
+
+
+class DedupIndex:
+    """
+    SQLite index of perceptual hashes (see processing.image_hashing.dhash) of images, grouped by kind
+    (e.g. "fields", "cells").
+
+    Hashes only select candidates: already indexed images of the same kind with a hash within max_distance bits.
+    Different images can have equal or close hashes, so a candidate is a duplicate only if it is confirmed:
+    "exact" duplicates have the same pixels (equal content digests), "near" duplicates are confirmed by the
+    caller, e.g. comparing pixels of both images (see processing.image_hashing.pixel_mse).
+    Only unique images are added to the in-memory BK-tree used for lookups, duplicates are recorded as aliases
+    of their canonical image. A value (e.g. a prediction) can be attached to each image, so work done on the
+    canonical image is reused for its duplicates.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS hashes (
+        kind TEXT NOT NULL,
+        path TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        digest TEXT,
+        canonical TEXT,
+        distance INTEGER,
+        value TEXT,
+        updated REAL,
+        PRIMARY KEY (kind, path)
+    )
+    """
+
+    DEFAULT_MAX_DISTANCE = 0
+
+    def __init__(self, db_path, max_distance=DEFAULT_MAX_DISTANCE):
+        """
+
+        :param db_path: SQLite database file path
+        :param max_distance: max Hamming distance (of 64 bits hashes) between candidate duplicate images,
+        0 to check only images with equal hashes
+        """
+        self.db_path = str(db_path)
+        self.max_distance = max_distance
+        self.exact = 0
+        self.near = 0
+        self.unique = 0
+
+        self._connection = sqlite3.connect(self.db_path, timeout=30)
+        self._connection.execute(DedupIndex.SCHEMA)
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(hashes)")]
+        if "digest" not in columns:  # index created before content digests, its images are never exact duplicates
+            self._connection.execute("ALTER TABLE hashes ADD COLUMN digest TEXT")
+        self._connection.commit()
+        self._trees = {}
+
+    def tree(self, kind):
+        """
+        :return: BKTree instance of (path, digest) items of unique images of a kind, loaded at first use
+        """
+        tree = self._trees.get(kind)
+        if tree is None:
+            tree = BKTree()
+            for path, image_hash, image_digest in self._connection.execute("SELECT path, hash, digest FROM hashes "
+                                                                           "WHERE kind = ? AND canonical IS NULL",
+                                                                           (kind,)):
+                tree.add(int(image_hash, 16), (path, image_digest))
+            self._trees[kind] = tree
+        return tree
+
+    def canonical_of(self, kind, path):
+        """
+        :return: canonical image path of an already indexed duplicate image, None if the image is unique or unknown
+        """
+        row = self._connection.execute("SELECT canonical FROM hashes WHERE kind = ? AND path = ?",
+                                       (kind, str(path))).fetchone()
+        return row[0] if row is not None else None
+
+    def check(self, kind, path, image=None, commit=True, confirm=None, hashes=None):
+        """
+        Look up an image in the index and add it, as unique image or as alias of its nearest confirmed duplicate.
+
+        :param kind: images group, duplicates are searched only among images of the same kind
+        :param path: image identifier, e.g. the file path
+        :param image: a numpy ndarray instance of a 3 channel RGB image, not needed if hashes is given
+        :param commit: if False the change is committed by a later commit call
+        :param confirm: optional function of a candidate canonical image path, returning True if the image is
+        a near duplicate of it. If None only images with the same pixels are duplicates
+        :param hashes: optional tuple of dhash and digest of the image, e.g. computed by a worker process
+        :return: tuple of canonical image path (None for unique images) and Hamming distance from it
+        """
+        path = str(path)
+        image_hash, image_digest = hashes if hashes is not None else (dhash(image), digest(image))
+        row = self._connection.execute("SELECT canonical, distance, digest FROM hashes WHERE kind = ? AND path = ?",
+                                       (kind, path)).fetchone()
+        if row is not None and row[2] == image_digest:  # already indexed, e.g. a forced run, keep its outcome
+            return row[0], row[1] or 0
+        if row is not None:
+            self._forget(kind, path)
+
+        tree = self.tree(kind)
+        canonical, distance, exact = find_duplicate(tree, image_hash, image_digest, self.max_distance, confirm)
+        if canonical is None:
+            tree.add(image_hash, (path, image_digest))
+            self.unique += 1
+        elif exact:
+            self.exact += 1
+        else:
+            self.near += 1
+
+        self._connection.execute("INSERT INTO hashes (kind, path, hash, digest, canonical, distance, updated) "
+                                 "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 (kind, path, "{:016x}".format(image_hash), image_digest, canonical, distance,
+                                  time.time()))
+        if commit:
+            self._connection.commit()
+
+        return canonical, distance
+
+    def _forget(self, kind, path):
+        # the image of an indexed path changed (e.g. a replaced field, or cells extracted again with the same names):
+        # its row, value and aliases are stale. Aliases are indexed again when they are checked
+        self._connection.execute("DELETE FROM hashes WHERE kind = ? AND (path = ? OR canonical = ?)",
+                                 (kind, path, path))
+        self._trees.pop(kind, None)  # the tree can't remove nodes, it is loaded again
+
+    def set_value(self, kind, path, value, commit=True):
+        """
+        Attach a JSON serializable value to an indexed image.
+        """
+        self._connection.execute("UPDATE hashes SET value = ? WHERE kind = ? AND path = ?",
+                                 (json.dumps(value), kind, str(path)))
+        if commit:
+            self._connection.commit()
+
+    def value(self, kind, path):
+        """
+        :return: value attached to an indexed image, None if missing
+        """
+        row = self._connection.execute("SELECT value FROM hashes WHERE kind = ? AND path = ?",
+                                       (kind, str(path))).fetchone()
+        return json.loads(row[0]) if row is not None and row[0] is not None else None
+
+    def summary(self, work_name="images"):
+        """
+        :return: string reporting duplicates found since the index was opened
+        """
+        total = self.exact + self.near + self.unique
+        skipped = self.exact + self.near
+        return "dedup: {} {} checked, {} exact and {} near duplicates skipped ({:.1f}% of work saved)".format(
+            total, work_name, self.exact, self.near, 100 * skipped / total if total else 0.0)
+
+    def commit(self):
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,143 @@
+# ---------------------------------------------------
+# On disk cache of cells detection results, keyed on
+# field image content and detection parameters
+# ---------------------------------------------------
+
+import os
+import json
+import shutil
+import zipfile
+import hashlib
+import logging
+from pathlib import Path
+
+import numpy as np
+
+
+class DetectionCache:
+    """
+    Content addressed on disk cache of detected cells labels.
+
+    Each entry is a compressed npz file named after the hash of the field image pixels and of the
+    detection parameters, so changing an image or a parameter never returns stale labels.
+    When the cache grows over max_size bytes the least recently used entries are evicted,
+    the last use time is the entry file modification time.
+    """
+
+    VERSION = 2  # increase when detection algorithm changes in a way not captured by parameters
+    DEFAULT_MAX_SIZE = 2 * 1024 ** 3
+
+    def __init__(self, cache_path, max_size=DEFAULT_MAX_SIZE):
+        """
+
+        :param cache_path: directory where cache entries are stored
+        :param max_size: max size in bytes of the cache directory
+        """
+        self.cache_path = Path(cache_path)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(field_image, params):
+        """
+        Compute the cache key of a field image.
+
+        :param field_image: a numpy ndarray instance of a 3 channel RGB image
+        :param params: dict of detection parameters
+        :return: hex digest string
+        """
+        image = np.ascontiguousarray(field_image)
+        digest = hashlib.sha256()
+        digest.update(json.dumps({"version": DetectionCache.VERSION,
+                                  "shape": image.shape,
+                                  "dtype": str(image.dtype),
+                                  "params": params}, sort_keys=True).encode())
+        digest.update(image.data)
+        return digest.hexdigest()
+
+    def _entry_path(self, key):
+        return self.cache_path / key[:2] / (key + ".npz")
+
+    def get(self, key):
+        """
+        Retrieve cached labels.
+
+        :param key: cache key computed with key method
+        :return: labels ndarray or None if key is not cached
+        """
+        path = self._entry_path(key)
+        try:
+            with np.load(str(path)) as entry:
+                labels = entry["labels"]
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):  # missing, evicted by another process or corrupted
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(str(path))  # mark as recently used
+        except OSError:
+            pass
+
+        self.hits += 1
+        return labels
+
+    def put(self, key, labels):
+        """
+        Store labels in the cache, evicting least recently used entries if cache size exceeds the limit.
+
+        :param key: cache key computed with key method
+        :param labels: labels ndarray
+        """
+        path = self._entry_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # write on a temporary file and rename, concurrent readers never see a partial entry
+        tmp_path = path.with_name("{}.{}.tmp.npz".format(key, os.getpid()))
+        np.savez_compressed(str(tmp_path), labels=labels)
+        os.replace(str(tmp_path), str(path))
+
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        for path in self.cache_path.glob("*/*.npz"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def size(self):
+        """
+        :return: total size in bytes of cache entries
+        """
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """
+        Remove least recently used entries until cache size is under the limit.
+        """
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_size:
+            return
+
+        for mtime, size, path in sorted(entries):
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+            logging.debug("evicted detection cache entry {}".format(path.name))
+            if total <= self.max_size:
+                break
+
+    def purge(self):
+        """
+        Remove every cache entry.
+        """
+        if self.cache_path.exists():
+            shutil.rmtree(str(self.cache_path))
+        logging.info("detection cache {} purged".format(self.cache_path))
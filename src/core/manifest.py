@@ -0,0 +1,142 @@
+# ---------------------------------------------------
+# Persistent manifest of processed images, allows to
+# resume interrupted batch processing
+# ---------------------------------------------------
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+
+class Manifest:
+    """
+    SQLite manifest recording for each input image of a processing stage its size, modification time
+    (and optionally content hash), processing status and produced cells.
+
+    An image is considered completed only if its status is "done" and its file didn't change since,
+    so interrupted runs are resumed and newly arrived or modified images are processed.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS images (
+        stage TEXT NOT NULL,
+        path TEXT NOT NULL,
+        size INTEGER,
+        mtime INTEGER,
+        checksum TEXT,
+        status TEXT NOT NULL,
+        ncells INTEGER,
+        cells TEXT,
+        error TEXT,
+        updated REAL,
+        PRIMARY KEY (stage, path)
+    )
+    """
+
+    def __init__(self, db_path, stage, checksum=False):
+        """
+
+        :param db_path: SQLite database file path
+        :param stage: name of the processing stage, e.g. "extraction" or "classification"
+        :param checksum: if True images are identified also by content hash, useful when modification times
+        are not reliable (e.g. copied datasets)
+        """
+        self.db_path = str(db_path)
+        self.stage = stage
+        self.checksum = checksum
+
+        self._connection = sqlite3.connect(self.db_path, timeout=30)
+        self._connection.execute(Manifest.SCHEMA)
+        self._connection.commit()
+
+    def _fingerprint(self, path):
+        stat = os.stat(path)
+        checksum = None
+        if self.checksum:
+            digest = hashlib.sha1()
+            with open(path, "rb") as file:
+                for chunk in iter(lambda: file.read(1024 ** 2), b""):
+                    digest.update(chunk)
+            checksum = digest.hexdigest()
+        return stat.st_size, stat.st_mtime_ns, checksum
+
+    def is_done(self, path):
+        """
+        :param path: image file path
+        :return: True if the image was completely processed and it didn't change since
+        """
+        row = self._connection.execute("SELECT size, mtime, checksum FROM images "
+                                       "WHERE stage = ? AND path = ? AND status = 'done'",
+                                       (self.stage, str(path))).fetchone()
+        if row is None:
+            return False
+
+        try:
+            fingerprint = self._fingerprint(path)
+        except OSError:  # not a file, e.g. a crop store cell, or a file moved away
+            fingerprint = (None, None, None)
+
+        return tuple(row) == fingerprint
+
+    def pending(self, paths):
+        """
+        :param paths: list of image file paths
+        :return: list of paths still to process, in the same order
+        """
+        return [path for path in paths if not self.is_done(path)]
+
+    def _update(self, path, status, ncells=None, cells=None, error=None, commit=True):
+        try:
+            size, mtime, checksum = self._fingerprint(path)
+        except OSError:
+            size, mtime, checksum = None, None, None
+
+        self._connection.execute("INSERT OR REPLACE INTO images "
+                                 "(stage, path, size, mtime, checksum, status, ncells, cells, error, updated) "
+                                 "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                 (self.stage, str(path), size, mtime, checksum, status, ncells,
+                                  json.dumps(cells) if cells is not None else None, error, time.time()))
+        if commit:
+            self._connection.commit()
+
+    def mark_running(self, path, commit=True):
+        self._update(path, "running", commit=commit)
+
+    def mark_done(self, path, ncells=None, cells=None, commit=True):
+        """
+        :param path: image file path
+        :param ncells: number of produced cells
+        :param cells: JSON serializable produced cells, e.g. cells names or predicted class
+        :param commit: if False the change is persisted by the next commit, to record many images at once
+        """
+        self._update(path, "done", ncells, cells, commit=commit)
+
+    def mark_failed(self, path, error, commit=True):
+        self._update(path, "failed", error=str(error), commit=commit)
+
+    def mark_rejected(self, path, reasons, commit=True):
+        """
+        Record an image skipped by the quality gate, it stays pending so it is checked again by the next run
+        (e.g. after a thresholds change).
+
+        :param path: image file path
+        :param reasons: list of failed quality checks reasons
+        :param commit: if False the change is persisted by the next commit
+        """
+        self._update(path, "rejected", error=", ".join(reasons), commit=commit)
+
+    def commit(self):
+        self._connection.commit()
+
+    def counts(self):
+        """
+        :return: dict of status: number of images of this stage
+        """
+        rows = self._connection.execute("SELECT status, COUNT(*) FROM images WHERE stage = ? GROUP BY status",
+                                        (self.stage,))
+        return dict(rows.fetchall())
+
+    def close(self):
+        self._connection.close()
@@ -0,0 +1,135 @@
+# ---------------------------------------------------
+# Parameter sweep of cells detection, each stage is
+# computed once for each distinct upstream parameters
+# prefix and shared among downstream variants
+# ---------------------------------------------------
+
+import itertools
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+from skimage import io
+from src.core import cell_extractor
+from src.core.cell_extractor import (meanshift_stage, threshold_stage, dilation_stage, distance_stage,
+                                     watershed_stage)
+
+# sweepable parameters grouped by the detect_cells stage they affect, in pipeline order
+STAGES_PARAMS = [("meanshift", ["meanshift_spatial_radius", "meanshift_color_radius"]),
+                 ("dilation", ["dilation_radius"]),
+                 ("watershed", ["min_distance"]),
+                 ("size_filter", ["low_threshold_size", "high_threshold_size"])]
+
+
+class ParameterSweep:
+    """
+    Run detect_cells over a grid of parameters reusing intermediate stages.
+
+    Stages are computed depth first: one mean shift feeds every dilation radius, each dilation
+    feeds every min_distance and each watershed feeds every size thresholds pair, so each stage
+    runs once per distinct upstream parameters prefix and only one branch of intermediate images
+    is kept in memory. Images are processed in parallel by a process pool.
+    """
+
+    def __init__(self, grid):
+        """
+
+        :param grid: dict of parameter name: list of values, see Extractor.detection_params for names.
+        Missing parameters take the cell_extractor module default
+        """
+        defaults = cell_extractor.Extractor.detection_params()
+        unknown = set(grid) - set(defaults)
+        if unknown:
+            raise ValueError("unknown detection parameters: {}".format(", ".join(sorted(unknown))))
+
+        self.grid = {name: list(grid.get(name, [default])) for name, default in defaults.items()}
+
+    def _stage_variants(self, stage_params):
+        return [dict(zip(stage_params, values))
+                for values in itertools.product(*[self.grid[name] for name in stage_params])]
+
+    def __len__(self):
+        return int(np.prod([len(values) for values in self.grid.values()]))
+
+    def run_image(self, image, image_id=None, meanshift=None):
+        """
+        Sweep the parameters grid on a single field image.
+
+        :param image: a numpy ndarray instance of a 3 channel RGB image, or its file path
+        :param image_id: identifier of the image in result rows, default is the file path
+        :param meanshift: dict of mean shift parameters, if not None only the grid branch of these parameters is run
+        :return: list of result rows dicts
+        """
+        if isinstance(image, str):
+            image_id = image_id or image
+            image = io.imread(image)
+
+        (_, meanshift_params), (_, dilation_params), (_, watershed_params), (_, filter_params) = STAGES_PARAMS
+        meanshift_variants = [meanshift] if meanshift is not None else self._stage_variants(meanshift_params)
+
+        rows = []
+        for meanshift in meanshift_variants:
+            shifted = meanshift_stage(image, meanshift["meanshift_spatial_radius"],
+                                      meanshift["meanshift_color_radius"])
+            gray, binary = threshold_stage(shifted)
+            del shifted, gray
+
+            for dilation in self._stage_variants(dilation_params):
+                dilated = dilation_stage(binary, dilation["dilation_radius"])
+                dist_map = distance_stage(dilated)
+
+                for watershed in self._stage_variants(watershed_params):
+                    try:
+                        labels = watershed_stage(dist_map, dilated, watershed["min_distance"])
+                    except ValueError:
+                        continue
+                    sizes = np.bincount(labels.ravel())[1:]
+                    sizes = sizes[sizes > 0]
+
+                    for size_filter in self._stage_variants(filter_params):
+                        # cells areas after size filter, without building the filtered labels image
+                        areas = sizes[(sizes >= size_filter["low_threshold_size"]) &
+                                      (sizes <= size_filter["high_threshold_size"])]
+
+                        row = {"image": image_id}
+                        for params in (meanshift, dilation, watershed, size_filter):
+                            row.update(params)
+                        row.update(ParameterSweep.area_stats(areas))
+                        rows.append(row)
+
+        return rows
+
+    @staticmethod
+    def area_stats(areas):
+        if len(areas) == 0:
+            return {"cells": 0, "mean_area": np.nan, "median_area": np.nan, "std_area": np.nan,
+                    "min_area": np.nan, "max_area": np.nan}
+
+        return {"cells": len(areas),
+                "mean_area": float(np.mean(areas)),
+                "median_area": float(np.median(areas)),
+                "std_area": float(np.std(areas)),
+                "min_area": int(np.min(areas)),
+                "max_area": int(np.max(areas))}
+
+    def run(self, images, workers=1):
+        """
+        Sweep the parameters grid on many field images.
+
+        :param images: list of images file paths or numpy ndarray instances of 3 channel RGB images
+        :param workers: number of worker processes, if None all available cores are used
+        :return: pandas DataFrame with a row for each image and parameters configuration, with cells count
+        and cells area statistics
+        """
+        # a job is a mean shift branch of an image, so a single image sweep runs in parallel too
+        meanshift_variants = self._stage_variants(STAGES_PARAMS[0][1])
+        jobs = [(image, image if isinstance(image, str) else i, meanshift)
+                for i, image in enumerate(images) for meanshift in meanshift_variants]
+
+        if workers == 1:
+            results = [self.run_image(*job) for job in jobs]
+        else:
+            with multiprocessing.Pool(workers) as pool:
+                results = pool.starmap(self.run_image, jobs)
+
+        return pd.DataFrame([row for rows in results for row in rows])
@@ -0,0 +1,145 @@
+# ---------------------------------------------------
+# Cells extraction and classification pipeline, cells
+# are handed from the extractor to the classifier in
+# memory without saving them on disk
+# ---------------------------------------------------
+
+import os
+import time
+import argparse
+import logging
+from datetime import timedelta
+from pathlib import Path
+from collections import namedtuple
+
+from skimage import io
+from src.core.cell_extractor import Extractor
+from src.core.classifier import Classifier
+from src.core.data_manager import DataManager
+from src.core.results import PredictionStore
+from src.core.quality_gate import QualityGate
+
+Prediction = namedtuple("Prediction", ["cell_name", "source", "bbox", "cell_class", "probabilities"])
+
+
+class Pipeline:
+    """
+    Detect, extract and classify cells streaming crops from the extractor into the classifier.
+
+    Cells crops are accumulated in batches and pre-processed together, so the PNG encode/decode
+    round trip between extraction and classification is avoided.
+    Crops are optionally saved directly into their predicted class directory and predictions
+    optionally appended to a results table.
+    """
+    def __init__(self, extractor, classifier, export_cells=False, results=None):
+        """
+
+        :param extractor: an instance of Extractor class
+        :param classifier: an instance of Classifier class
+        :param export_cells: if True each cell crop is saved in its class directory
+        :param results: an instance of PredictionStore class, if not None predictions are appended to it
+        """
+        self.extractor = extractor
+        self.classifier = classifier
+        self.data_manager = extractor.data_manager
+        self.export_cells = export_cells
+        self.results = results
+
+    def iter_cells(self):
+        """
+        Detect and crop cells from every image retrieved with the DataManager instance.
+
+        :return: generator of tuples (cell name, source image path, CellCrop namedtuple)
+        """
+        for infile in self.extractor.images:
+            logging.info("detecting cells in {} image".format(infile))
+
+            image = io.imread(infile)
+            quality, rejected = self.extractor.triage(infile, image)
+            if rejected:
+                continue
+
+            try:
+                labels, cache_outcome = self.extractor.detect_cells_cached(image)
+            except ValueError:
+                continue
+
+            prefix = Path(infile).stem
+            for crop in self.extractor.crop_cells(image, labels):
+                cell_name = self.extractor.cell_file_name(prefix, crop.index)
+                yield cell_name, infile, crop
+
+    def _classify_pending(self, pending):
+        batch = Classifier.pre_process_batch([crop.image for _, _, crop in pending])
+        classes, probabilities = self.classifier.predict_batch(batch)
+
+        predictions = []
+        for (cell_name, infile, crop), cell_class, probs in zip(pending, classes, probabilities):
+            class_path = self.data_manager.get_cell_class_path(cell_class)
+            if self.export_cells:
+                io.imsave(os.path.join(class_path, cell_name), crop.image)
+
+            logging.info("Predicted class for cell {}: {}".format(cell_name, class_path))
+            predictions.append(Prediction(cell_name, infile, crop.bbox, int(cell_class), probs))
+
+        if self.results is not None:
+            self.results.append([(p.cell_name, Path(p.source).stem, p.bbox, p.cell_class, p.probabilities)
+                                 for p in predictions], self.classifier.model_version)
+
+        return predictions
+
+    def batch_process(self, batch_size=None):
+        """
+        Detect, extract and classify cells of every image retrieved with the DataManager instance.
+
+        :param batch_size: number of cells classified by each model call, default is Classifier.BATCH_SIZE
+        :return: list of Prediction namedtuple, one for each detected cell
+        """
+        logging.basicConfig(level=logging.INFO, format="[%(asctime)s] - [%(name)s] - [%(levelname)s] - %(message)s")
+        batch_size = batch_size or Classifier.BATCH_SIZE
+
+        start_time = time.monotonic()
+
+        predictions = []
+        pending = []
+        for cell_name, infile, crop in self.iter_cells():
+            # crops are views, a field image is released once all its cells are classified
+            pending.append((cell_name, infile, crop))
+
+            if len(pending) == batch_size:
+                predictions.extend(self._classify_pending(pending))
+                pending = []
+
+        if pending:
+            predictions.extend(self._classify_pending(pending))
+
+        end_time = time.monotonic()
+        logging.info("cells extraction and classification time: {}".format(timedelta(seconds=end_time - start_time)))
+
+        return predictions
+
+
+def setup_parser():
+
+    parser = argparse.ArgumentParser(description="Detect, extract and classify cells from microscope field images")
+
+    parser.add_argument("--config", default="config.ini", help="Configuration file")
+    parser.add_argument("--batch-size", type=int, default=Classifier.BATCH_SIZE,
+                        help="Number of cells classified by each model call")
+    parser.add_argument("--export-cells", action="store_true",
+                        help="Save each cell image in its predicted class directory")
+    parser.add_argument("--results-table", action="store_true",
+                        help="Store predictions in the results table")
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = setup_parser().parse_args()
+
+    data_manager = DataManager.from_file(args.config)
+    results = PredictionStore(data_manager.get_results_path()) if args.results_table else None
+    extractor = Extractor(data_manager, quality_gate=QualityGate.from_file(args.config))
+    pipeline = Pipeline(extractor, Classifier(args.config, data_manager),
+                        export_cells=args.export_cells, results=results)
+    pipeline.batch_process(batch_size=args.batch_size)
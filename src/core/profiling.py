@@ -0,0 +1,103 @@
+# ---------------------------------------------------
+# Per stage cost instrumentation of cells detection
+# ---------------------------------------------------
+
+import csv
+import json
+import time
+import logging
+from collections import OrderedDict
+
+STAGE_RECORD_FIELDS = ["image", "stage", "seconds", "bytes"]
+
+
+class StageProfiler:
+    """
+    Record wall time and allocated bytes of each stage of an algorithm, without keeping stage images.
+
+    The allocated bytes of a stage are the bytes of the array the stage produces.
+    Records of several images (and processes) can be merged with extend, aggregated and exported
+    as JSON lines or CSV structured records.
+    """
+
+    def __init__(self, image=None):
+        """
+
+        :param image: identifier of the processed image, e.g. its file path
+        """
+        self.image = image
+        self.records = []
+        self._last = time.perf_counter()
+
+    def start(self, image=None):
+        """
+        Start timing a new image.
+
+        :param image: identifier of the processed image
+        """
+        if image is not None:
+            self.image = image
+        self._last = time.perf_counter()
+
+    def mark(self, stage, output):
+        """
+        Record a completed stage, its time is the time elapsed since the previous mark or start call.
+
+        :param stage: stage name
+        :param output: ndarray produced by the stage
+        """
+        now = time.perf_counter()
+        self.records.append({"image": self.image,
+                             "stage": stage,
+                             "seconds": now - self._last,
+                             "bytes": int(getattr(output, "nbytes", 0))})
+        self._last = now
+
+    def extend(self, records):
+        """
+        Merge records of another profiler, e.g. from a worker process.
+
+        :param records: list of stage records
+        """
+        self.records.extend(records)
+
+    def aggregate(self):
+        """
+        Aggregate records by stage, stages are kept in the order they are first recorded.
+
+        :return: OrderedDict of stage name: dict with count, total seconds, mean seconds and max bytes
+        """
+        stages = OrderedDict()
+        for record in self.records:
+            stage = stages.setdefault(record["stage"], {"count": 0, "seconds": 0.0, "max_bytes": 0})
+            stage["count"] += 1
+            stage["seconds"] += record["seconds"]
+            stage["max_bytes"] = max(stage["max_bytes"], record["bytes"])
+
+        for stage in stages.values():
+            stage["mean_seconds"] = stage["seconds"] / stage["count"]
+
+        return stages
+
+    def log_summary(self):
+        stages = self.aggregate()
+        total = sum(stage["seconds"] for stage in stages.values())
+        for name, stage in stages.items():
+            logging.info("stage {}: {:.3f}s total, {:.3f}s mean, {:.1%} of detection time, {:.1f}MB max".format(
+                name, stage["seconds"], stage["mean_seconds"],
+                stage["seconds"] / total if total else 0, stage["max_bytes"] / 1024 ** 2))
+
+    def export(self, out_file):
+        """
+        Export records as CSV if out_file has .csv extension, as JSON lines otherwise.
+
+        :param out_file: output file path
+        """
+        with open(str(out_file), "w", newline="") as file:
+            if str(out_file).endswith(".csv"):
+                writer = csv.DictWriter(file, fieldnames=STAGE_RECORD_FIELDS)
+                writer.writeheader()
+                writer.writerows(self.records)
+            else:
+                for record in self.records:
+                    file.write(json.dumps(record) + "\n")
@@ -0,0 +1,96 @@
+# ---------------------------------------------------
+# Pre-detection triage of blank, out of focus
+# or saturated microscope fields
+# ---------------------------------------------------
+
+import configparser
+
+from src.processing.quality import quality_metrics
+
+
+class QualityGate:
+    """
+    Reject (or flag) unusable field images before cells detection, checking cheap quality metrics
+    computed on a downsampled copy of the image (see processing.quality.quality_metrics) against thresholds.
+
+    Thresholds are read from the [Quality] section of the configuration file, a threshold set to None is not checked.
+    """
+
+    ACTIONS = ("reject", "flag")
+    DEFAULT_ACTION = "flag"  # thresholds must be calibrated on sample fields before rejecting them
+
+    def __init__(self, action=DEFAULT_ACTION, max_side=512, min_contrast=None, min_foreground=None,
+                 min_focus=None, max_saturated=None):
+        """
+
+        :param action: "reject" to skip detection of unusable fields, "flag" to only report them
+        :param max_side: side of the downsampled copy where metrics are computed
+        :param min_contrast: fields with smaller gray levels standard deviation are "low_contrast"
+        :param min_foreground: fields with smaller foreground fraction are "blank"
+        :param min_focus: fields with smaller laplacian variance are "out_of_focus"
+        :param max_saturated: fields with bigger fraction of clipped pixels are "saturated"
+        """
+        if action not in QualityGate.ACTIONS:
+            raise ValueError("unknown quality gate action {}, expected one of {}".format(action, QualityGate.ACTIONS))
+
+        self.action = action
+        self.max_side = max_side
+        self.min_contrast = min_contrast
+        self.min_foreground = min_foreground
+        self.min_focus = min_focus
+        self.max_saturated = max_saturated
+
+    @classmethod
+    def from_file(cls, config_file="config.ini"):
+        """
+        Build a QualityGate instance from the [Quality] section of a configuration file.
+        :param config_file: the configuration file
+        :return: a QualityGate instance, or None if the section is missing or enabled is false
+        """
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        if not config.has_section("Quality"):
+            return None
+
+        section = config["Quality"]
+        if not section.getboolean("enabled", fallback=True):
+            return None
+
+        def threshold(name):
+            value = section.get(name, fallback="").strip()
+            return float(value) if value else None
+
+        return cls(action=section.get("action", fallback=cls.DEFAULT_ACTION),
+                   max_side=section.getint("max_side", fallback=512),
+                   min_contrast=threshold("min_contrast"),
+                   min_foreground=threshold("min_foreground"),
+                   min_focus=threshold("min_focus"),
+                   max_saturated=threshold("max_saturated"))
+
+    def check(self, image):
+        """
+        Compute quality metrics of a field image and check them against thresholds.
+
+        :param image: a numpy ndarray (or memmap) instance of a 3 channel RGB image
+        :return: tuple of QualityMetrics namedtuple and list of failed checks reasons, empty for usable fields
+        """
+        metrics = quality_metrics(image, self.max_side)
+
+        reasons = []
+        if self.min_contrast is not None and metrics.contrast < self.min_contrast:
+            reasons.append("low_contrast")
+        if self.min_foreground is not None and metrics.foreground < self.min_foreground:
+            reasons.append("blank")
+        if self.min_focus is not None and metrics.focus < self.min_focus:
+            reasons.append("out_of_focus")
+        if self.max_saturated is not None and metrics.saturated > self.max_saturated:
+            reasons.append("saturated")
+
+        return metrics, reasons
+
+    def rejects(self, reasons):
+        """
+        :param reasons: failed checks reasons returned by check method
+        :return: True if the field must not be processed
+        """
+        return bool(reasons) and self.action == "reject"
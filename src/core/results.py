@@ -0,0 +1,138 @@
+# ---------------------------------------------------
+# Classification results table, predictions are stored
+# in bulk instead of moving each cell image file
+# ---------------------------------------------------
+
+import os
+import json
+import time
+import shutil
+import logging
+import sqlite3
+from pathlib import Path
+
+from skimage import io
+
+
+class PredictionStore:
+    """
+    SQLite table of cells predictions: cell id, source field, bbox, class, per class probabilities
+    and model version.
+
+    Predictions are append only: classifying again with another model version adds new rows,
+    classifying again with the same model version replaces the previous ones.
+    Class directories can be materialised afterwards with links to cells image files.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS predictions (
+        cell_id TEXT NOT NULL,
+        source TEXT,
+        bbox TEXT,
+        class INTEGER NOT NULL,
+        probabilities TEXT,
+        model_version TEXT NOT NULL,
+        created REAL,
+        PRIMARY KEY (cell_id, model_version)
+    )
+    """
+
+    def __init__(self, db_path):
+        """
+
+        :param db_path: SQLite database file path
+        """
+        self.db_path = str(db_path)
+        self._connection = sqlite3.connect(self.db_path, timeout=30)
+        self._connection.execute(PredictionStore.SCHEMA)
+        self._connection.commit()
+
+    @staticmethod
+    def source_of(cell_name):
+        """
+        :param cell_name: cell image file name or path, see Extractor.cell_file_name
+        :return: the source field image name
+        """
+        return Path(cell_name).stem.rsplit("_cell#", 1)[0]
+
+    def append(self, predictions, model_version):
+        """
+        Store a batch of predictions in a single transaction.
+
+        :param predictions: iterable of tuples (cell id, source, bbox, class index, probabilities)
+        :param model_version: version string of the classifier model
+        """
+        now = time.time()
+        rows = [(str(cell_id), source, json.dumps(bbox) if bbox is not None else None, int(cell_class),
+                 json.dumps([float(p) for p in probabilities]) if probabilities is not None else None,
+                 model_version, now)
+                for cell_id, source, bbox, cell_class, probabilities in predictions]
+
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO predictions "
+                                         "(cell_id, source, bbox, class, probabilities, model_version, created) "
+                                         "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def latest_version(self):
+        row = self._connection.execute("SELECT model_version FROM predictions "
+                                       "ORDER BY created DESC LIMIT 1").fetchone()
+        return row[0] if row is not None else None
+
+    def predictions(self, model_version=None):
+        """
+        :param model_version: version of predictions to read, default is the last stored version
+        :return: list of tuples (cell id, source, bbox, class index, probabilities)
+        """
+        model_version = model_version or self.latest_version()
+        rows = self._connection.execute("SELECT cell_id, source, bbox, class, probabilities FROM predictions "
+                                        "WHERE model_version = ? ORDER BY cell_id", (model_version,))
+
+        return [(cell_id, source, json.loads(bbox) if bbox else None, cell_class,
+                 json.loads(probabilities) if probabilities else None)
+                for cell_id, source, bbox, cell_class, probabilities in rows]
+
+    def materialize(self, data_manager, mode="hardlink", model_version=None, store=None):
+        """
+        Build class directories from stored predictions, linking (or copying) each cell image file
+        in its class directory. Cells of a crop store are exported as image files.
+
+        :param data_manager: an instance of DataManager class
+        :param mode: "hardlink", "symlink" or "copy"
+        :param model_version: version of predictions to materialise, default is the last stored version
+        :param store: an instance of CropStore class, needed to materialise cells of a crop store
+        :return: number of materialised cells
+        """
+        records = {record.cell_name: record for record in store.records} if store is not None else {}
+        by_class = {}
+        for cell_id, source, bbox, cell_class, probabilities in self.predictions(model_version):
+            by_class.setdefault(cell_class, []).append(cell_id)
+
+        count = 0
+        for cell_class, cell_ids in by_class.items():
+            class_path = Path(data_manager.get_cell_class_path(cell_class))
+            class_path.mkdir(parents=True, exist_ok=True)
+
+            for cell_id in cell_ids:
+                destination = class_path / Path(cell_id).name
+                if destination.exists():
+                    continue
+
+                if os.path.isfile(cell_id):
+                    if mode == "hardlink":
+                        os.link(cell_id, str(destination))
+                    elif mode == "symlink":
+                        os.symlink(os.path.abspath(cell_id), str(destination))
+                    else:
+                        shutil.copy(cell_id, str(destination))
+                elif cell_id in records:
+                    io.imsave(str(destination), store.get(records[cell_id]))
+                else:
+                    logging.warning("cell {} not found, not materialised".format(cell_id))
+                    continue
+                count += 1
+
+        logging.info("materialised {} cells in {}".format(count, data_manager.get_output_path()))
+        return count
+
+    def close(self):
+        self._connection.close()
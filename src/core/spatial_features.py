@@ -0,0 +1,296 @@
+# ---------------------------------------------------
+# Batch computation of fields spatial distribution
+# features (density, agglomeration, clusterness)
+# ---------------------------------------------------
+
+import os
+import csv
+import time
+import logging
+import argparse
+import multiprocessing
+from pathlib import Path
+
+import cv2
+from skimage import io
+from src.core.data_manager import DataManager
+from src.core.detection_cache import DetectionCache
+from src.processing.image_processing import binarization, watershed_segmentation
+from src.processing.feature_extraction import density, agglomeration, clusterness
+
+FEATURES = ["image", "group", "density", "sparsity", "agglomeration", "cells", "clusterness", "total_area"]
+WATERSHED_MIN_DISTANCE = 25
+PARQUET_ROW_GROUP = 256
+
+# features extractor instance owned by each worker process of the pool, see _init_worker
+_worker_features = None
+
+
+class SpatialFeatures:
+    """
+    Compute spatial distribution features of every field image of a DataManager instance and stream them
+    to a table, one row for each image, as the spatial distribution experiment does from a notebook.
+
+    Binarized images are stored in a DetectionCache instance, so features can be computed again
+    (e.g. after a feature change) without the mean shift filtering cost.
+    """
+
+    def __init__(self, data_manager, cache=None, group=None, min_distance=WATERSHED_MIN_DISTANCE):
+        """
+
+        :param data_manager: an instance of DataManager class
+        :param cache: an instance of DetectionCache class, if not None binarizations are cached
+        :param group: value of the group column of each row, e.g. the field preparation technique ("sm", "cyt")
+        :param min_distance: min distance between cells centers used by watershed segmentation
+        """
+        self.data_manager = data_manager
+        self.cache = cache
+        self.group = group
+        self.min_distance = min_distance
+
+    def binarize(self, image):
+        """
+        Binarize a field image, reading it from the cache when available.
+
+        :param image: a numpy ndarray instance of a 3 channel RGB image
+        :return: tuple of binary ndarray (255 is foreground) and cache outcome: "hit", "miss" or None without cache
+        """
+        if self.cache is None:
+            return binarization(image), None
+
+        key = self.cache.key(image, {"stage": "binarization"})
+        binary = self.cache.get(key)
+        if binary is not None:
+            return binary, "hit"
+
+        binary = binarization(image)
+        self.cache.put(key, binary)
+        return binary, "miss"
+
+    def image_features(self, infile):
+        """
+        Compute spatial features of a field image.
+
+        :param infile: field image file path
+        :return: tuple of dict of FEATURES values and binarization cache outcome
+        """
+        image = io.imread(infile)[..., :3]
+        binary, cache_status = self.binarize(image)
+        labels = watershed_segmentation(binary, self.min_distance)
+
+        image_density = density(binary)
+        image_clusterness, ncells, total_area = clusterness(labels)
+
+        return {"image": Path(infile).name,
+                "group": self.group,
+                "density": image_density,
+                "sparsity": 1 - image_density,
+                "agglomeration": agglomeration(labels),
+                "cells": ncells,
+                "clusterness": image_clusterness,
+                "total_area": total_area}, cache_status
+
+    def _run_job(self, infile):
+        try:
+            row, cache_status = self.image_features(infile)
+            return infile, row, cache_status, None
+        except (OSError, ValueError) as error:
+            return infile, None, None, str(error)
+
+    def _process(self, images, workers):
+        if workers == 1:
+            for infile in images:
+                yield self._run_job(infile)
+            return
+
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(self,)) as pool:
+            # imap keeps input order, so tables are the same of a serial run
+            for result in pool.imap(_features_job, images):
+                yield result
+
+    def batch_process(self, out_file, workers=1, resume=True):
+        """
+        Compute features of each input image of the DataManager instance, appending a row to out_file
+        as soon as an image is processed.
+
+        :param out_file: output table file path, .csv or .parquet (needs pyarrow)
+        :param workers: number of worker processes, images are processed serially when 1.
+        If None all available cores are used.
+        :param resume: if True and out_file is a csv file, images already in it are skipped and rows are appended
+        """
+        logging.basicConfig(level=logging.INFO, format="[%(asctime)s] - [%(name)s] - [%(levelname)s] - %(message)s")
+
+        images = sorted(self.data_manager.get_input_images())
+        writer = TableWriter(out_file, resume=resume)
+        # tables can hold several groups of fields with the same names, e.g. a sm and a cyt run
+        group = "" if self.group is None else str(self.group)
+        ntotal = len(images)
+        images = [infile for infile in images if (group, Path(infile).name) not in writer.done]
+        logging.info("computing spatial features of {} images, {} already in {}".format(
+            len(images), ntotal - len(images), out_file))
+
+        start_time = time.monotonic()
+        nrows = 0
+        cache_counts = {"hit": 0, "miss": 0}
+        try:
+            for infile, row, cache_status, error in self._process(images, workers):
+                if error is not None:
+                    logging.warning("image {} skipped: {}".format(infile, error))
+                    continue
+
+                writer.write(row)
+                nrows += 1
+                if cache_status is not None:
+                    cache_counts[cache_status] += 1
+        finally:
+            writer.close()
+
+        elapsed = time.monotonic() - start_time
+        if self.cache is not None:
+            logging.info("binarization cache: {} hits, {} misses".format(cache_counts["hit"], cache_counts["miss"]))
+        logging.info("{} rows written in {:.1f}s ({:.2f} fields/s)".format(nrows, elapsed,
+                                                                           nrows / elapsed if elapsed else 0.0))
+
+    @staticmethod
+    def experiment_tables(features_file, out_path, groups=("sm", "cyt")):
+        """
+        Build the density and agglomeration tables of the spatial distribution experiment from a features table:
+        one column for each group, with the same number of rows (the smallest group size), as the notebook does.
+
+        :param features_file: features table file path, .csv or .parquet
+        :param out_path: directory of density_dataframe.csv and agglomeration_dataframe.csv
+        :param groups: values of the group column, in columns order
+        """
+        import pandas as pd
+
+        if str(features_file).endswith(".parquet"):
+            features = pd.read_parquet(features_file)
+        else:
+            features = pd.read_csv(features_file)
+
+        by_group = {group: features[features["group"] == group].reset_index(drop=True) for group in groups}
+        nrows = min(len(rows) for rows in by_group.values())
+
+        density_df = pd.DataFrame()
+        for group in groups:
+            density_df["{}_dens".format(group)] = by_group[group]["density"][:nrows]
+        for group in groups:
+            density_df["{}_spars".format(group)] = by_group[group]["sparsity"][:nrows]
+
+        agglomeration_df = pd.DataFrame({group: by_group[group]["agglomeration"][:nrows] for group in groups},
+                                        columns=list(groups))
+
+        out_path = Path(out_path)
+        density_df.to_csv(str(out_path / "density_dataframe.csv"), index=False)
+        agglomeration_df.to_csv(str(out_path / "agglomeration_dataframe.csv"), index=False)
+        logging.info("experiment tables of {} fields for each group saved in {}".format(nrows, out_path))
+
+
+class TableWriter:
+    """
+    Append features rows to a csv file, or to a parquet file in row groups of PARQUET_ROW_GROUP rows.
+    """
+
+    def __init__(self, out_file, resume=True):
+        self.out_file = str(out_file)
+        self.parquet = self.out_file.endswith(".parquet")
+        self.done = set()  # (group, image) pairs already in the table
+        self._rows = []
+        self._writer = None
+
+        if self.parquet:
+            return  # parquet files can't be appended, the table is written again
+
+        exists = resume and os.path.exists(self.out_file) and os.path.getsize(self.out_file) > 0
+        if exists:
+            with open(self.out_file, newline="") as file:
+                self.done = {(row.get("group") or "", row["image"]) for row in csv.DictReader(file)}
+
+        self._file = open(self.out_file, "a" if exists else "w", newline="")
+        self._writer = csv.DictWriter(self._file, fieldnames=FEATURES)
+        if not exists:
+            self._writer.writeheader()
+
+    def write(self, row):
+        if not self.parquet:
+            self._writer.writerow(row)
+            self._file.flush()  # rows are visible as soon as images are processed
+            return
+
+        self._rows.append(row)
+        if len(self._rows) >= PARQUET_ROW_GROUP:
+            self._flush_parquet()
+
+    def _flush_parquet(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if not self._rows:
+            return
+        table = pa.Table.from_arrays([pa.array([row[name] for row in self._rows]) for name in FEATURES], FEATURES)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.out_file, table.schema)
+        self._writer.write_table(table)
+        self._rows = []
+
+    def close(self):
+        if self.parquet:
+            self._flush_parquet()
+            if self._writer is not None:
+                self._writer.close()
+        else:
+            self._file.close()
+
+
+def _init_worker(features):
+    global _worker_features
+    _worker_features = features
+
+    cv2.setNumThreads(1)  # parallelism is given by the pool, avoid threads oversubscription
+
+
+def _features_job(infile):
+    return _worker_features._run_job(infile)
+
+
+def setup_parser():
+
+    parser = argparse.ArgumentParser(description="Compute spatial distribution features of microscope field images")
+
+    parser.add_argument("--config", default="config.ini", help="Configuration file")
+    parser.add_argument("--input-path", default=None,
+                        help="Directory of field images, default is input_path of configuration file")
+    parser.add_argument("--group", default=None,
+                        help="Group column value of each row (e.g. sm, cyt), default is the input directory name")
+    parser.add_argument("--out", default="spatial_features.csv", help="Features table file, .csv or .parquet")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes, 0 to use all available cores")
+    parser.add_argument("--no-cache", action="store_true", help="Don't cache binarized images")
+    parser.add_argument("--cache-size", type=int, default=DetectionCache.DEFAULT_MAX_SIZE // 1024 ** 2,
+                        help="Max binarization cache size in MB")
+    parser.add_argument("--force", action="store_true", help="Write the table again, also for images already in it")
+    parser.add_argument("--experiment-tables", default=None, metavar="OUT_PATH",
+                        help="Build density and agglomeration experiment tables from the features table and exit")
+    parser.add_argument("--groups", nargs="+", default=["sm", "cyt"], help="Groups of experiment tables columns")
+
+    return parser
+
+
+if __name__ == "__main__":
+    args = setup_parser().parse_args()
+
+    if args.experiment_tables:
+        logging.basicConfig(level=logging.INFO, format="[%(asctime)s] - [%(name)s] - [%(levelname)s] - %(message)s")
+        SpatialFeatures.experiment_tables(args.out, args.experiment_tables, args.groups)
+        raise SystemExit(0)
+
+    data_manager = DataManager.from_file(args.config)
+    if args.input_path:
+        data_manager.input_path = Path(args.input_path)
+
+    cache = None
+    if not args.no_cache:
+        cache = DetectionCache(data_manager.get_binarization_cache_path(), args.cache_size * 1024 ** 2)
+
+    features = SpatialFeatures(data_manager, cache=cache, group=args.group or data_manager.input_path.name)
+    features.batch_process(args.out, workers=args.workers or None, resume=not args.force)
@@ -0,0 +1,165 @@
+"""
+TensorFlow Lite inference backend for the cells classifier.
+
+The trained keras model is converted in a flat buffer artifact, optionally with int8 post training
+quantization calibrated on sample cells crops, and run with the TFLite interpreter, that has a much
+smaller per call overhead than keras predict on CPU only nodes.
+"""
+
+import os
+import time
+import logging
+import tempfile
+
+import numpy as np
+
+
+def load_interpreter_class():
+    """
+    Import the TFLite interpreter, from the standalone tflite_runtime package if installed
+    (it doesn't need the full tensorflow package) otherwise from tensorflow.
+    """
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+
+    return Interpreter
+
+
+def export_tflite(keras_model, out_path, calibration_images=None):
+    """
+    Convert a keras model in a TFLite artifact.
+
+    :param keras_model: a keras model instance, with trained weights loaded
+    :param out_path: artifact file path
+    :param calibration_images: optional float32 ndarray of pre-processed cells images of shape
+    (n, INPUT_IMAGE_WIDTH, INPUT_IMAGE_HEIGHT, 3), if given weights and activations are quantized to int8
+    using these images to estimate activations ranges; input and output stay float32
+    :return: artifact size in bytes
+    """
+    import tensorflow as tf
+
+    # the converter loads models from file, so standalone keras and tf.keras models are both supported
+    fd, model_file = tempfile.mkstemp(suffix=".h5")
+    os.close(fd)
+    try:
+        keras_model.save(model_file, include_optimizer=False)
+        converter = tf.lite.TFLiteConverter.from_keras_model_file(model_file)
+    finally:
+        os.remove(model_file)
+
+    if calibration_images is not None:
+        def representative_dataset():
+            for image in calibration_images:
+                yield [image[np.newaxis].astype(np.float32)]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = tf.lite.RepresentativeDataset(representative_dataset)
+
+    flat_buffer = converter.convert()
+    with open(out_path, "wb") as file:
+        file.write(flat_buffer)
+
+    logging.info("TFLite model saved in {} ({:.1f}KB{})".format(
+        out_path, len(flat_buffer) / 1024,
+        ", int8 quantized on {} images".format(len(calibration_images)) if calibration_images is not None else ""))
+
+    return len(flat_buffer)
+
+
+class TFLiteModel:
+    """
+    Run a TFLite classifier artifact with the same predict interface of keras models,
+    so it can be used as Classifier model.
+    """
+
+    def __init__(self, model_path, num_threads=None):
+        """
+        :param model_path: TFLite artifact file path, see export_tflite
+        :param num_threads: number of interpreter threads, if None the interpreter default
+        """
+        Interpreter = load_interpreter_class()
+        kwargs = {"num_threads": num_threads} if num_threads else {}
+        self.model_path = model_path
+        self.interpreter = Interpreter(model_path=model_path, **kwargs)
+        self.interpreter.allocate_tensors()
+
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self._batch_size = int(self._input["shape"][0])
+
+    def _resize(self, batch_size):
+        # interpreter tensors have a static shape, reallocate only when batch size changes
+        if batch_size != self._batch_size:
+            shape = [batch_size] + [int(dim) for dim in self._input["shape"][1:]]
+            self.interpreter.resize_tensor_input(self._input["index"], shape)
+            self.interpreter.allocate_tensors()
+            self._batch_size = batch_size
+
+    def predict(self, batch, batch_size=None):
+        """
+        Compute class probabilities of a batch of pre-processed cells images.
+
+        :param batch: float32 ndarray of shape (n, INPUT_IMAGE_WIDTH, INPUT_IMAGE_HEIGHT, 3)
+        :param batch_size: ignored, the whole batch is run with a single interpreter call
+        :return: ndarray of shape (n, classes)
+        """
+        self._resize(len(batch))
+
+        input_type = self._input["dtype"]
+        if input_type in (np.int8, np.uint8):  # fully quantized input
+            scale, zero_point = self._input["quantization"]
+            batch = np.round(batch / scale + zero_point).astype(input_type)
+        self.interpreter.set_tensor(self._input["index"], np.ascontiguousarray(batch, dtype=input_type))
+        self.interpreter.invoke()
+
+        probabilities = self.interpreter.get_tensor(self._output["index"])
+        if self._output["dtype"] in (np.int8, np.uint8):
+            scale, zero_point = self._output["quantization"]
+            probabilities = (probabilities.astype(np.float32) - zero_point) * scale
+
+        return probabilities
+
+    def predict_classes(self, batch, batch_size=None):
+        probabilities = self.predict(batch, batch_size)
+        if probabilities.shape[-1] > 1:
+            return probabilities.argmax(axis=-1)
+
+        return (probabilities > 0.5).astype(np.int32).ravel()
+
+
+def compare_models(reference, candidate, batch, batch_size=64, repeat=3):
+    """
+    Check accuracy parity and compare throughput of two models on the same images.
+
+    :param reference: a model with keras predict interface, e.g. the trained keras model
+    :param candidate: a model with keras predict interface, e.g. a TFLiteModel instance
+    :param batch: float32 ndarray of pre-processed cells images
+    :param batch_size: number of images of each predict call
+    :param repeat: number of timed passes over the images, best one is reported
+    :return: dict of top-1 agreement, max probability difference and throughput (images/s) of both models
+    """
+    def predict_all(model):
+        return np.concatenate([model.predict(batch[start:start + batch_size], batch_size=batch_size)
+                               for start in range(0, len(batch), batch_size)])
+
+    def throughput(model):
+        predict_all(model)  # warm up
+        best = float("inf")
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            predict_all(model)
+            best = min(best, time.perf_counter() - start_time)
+        return len(batch) / best
+
+    reference_probabilities = predict_all(reference)
+    candidate_probabilities = predict_all(candidate)
+
+    return {"images": len(batch),
+            "agreement": float(np.mean(reference_probabilities.argmax(axis=-1) ==
+                                       candidate_probabilities.argmax(axis=-1))),
+            "max_probability_difference": float(np.abs(reference_probabilities - candidate_probabilities).max()),
+            "reference_throughput": throughput(reference),
+            "candidate_throughput": throughput(candidate)}
@@ -0,0 +1,196 @@
+# ---------------------------------------------------
+# Lease based work queue on a shared SQLite file,
+# spreads batch processing over many nodes
+# ---------------------------------------------------
+
+import os
+import time
+import socket
+import sqlite3
+import threading
+
+
+class WorkQueue:
+    """
+    Work queue of images of a processing stage, stored in a SQLite file on a directory shared by every node
+    (no external broker), so workers on different hosts claim disjoint images.
+
+    A worker claims images taking a lease on them, that expires after lease_time seconds: images leased by
+    a crashed worker are claimed again by other workers once their lease expires. Leases of a worker are
+    renewed every time it completes an image, and an image is completed only by the owner of its lease,
+    so each image is recorded done exactly once.
+
+    Items are stored relative to a root directory, so nodes mounting the shared directory on different paths
+    share the same items.
+
+    The shared file system must support SQLite file locking (e.g. a local disk or a NFS mount with locks enabled).
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS tasks (
+        stage TEXT NOT NULL,
+        item TEXT NOT NULL,
+        status TEXT NOT NULL,
+        owner TEXT,
+        lease_expires REAL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        updated REAL,
+        PRIMARY KEY (stage, item)
+    )
+    """
+
+    DEFAULT_LEASE_TIME = 30 * 60
+    DEFAULT_MAX_ATTEMPTS = 3
+
+    def __init__(self, db_path, stage, root=None, worker_id=None, lease_time=DEFAULT_LEASE_TIME,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+
+        :param db_path: SQLite database file path, on a directory shared by every node
+        :param stage: name of the processing stage, e.g. "extraction" or "classification"
+        :param root: directory of the items file paths, e.g. the input path. If None items are stored as they are
+        :param worker_id: unique name of this worker, default is <hostname>-<pid>
+        :param lease_time: seconds after which images claimed and not completed are claimed again by other workers
+        :param max_attempts: an image failing this number of times is not claimed again
+        """
+        self.db_path = str(db_path)
+        self.stage = stage
+        self.worker_id = worker_id or "{}-{}".format(socket.gethostname(), os.getpid())
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.root = str(root) if root is not None else None
+        # items finished before this time are queued again by enqueue, see enqueue
+        self._opened = time.time()
+
+        # transactions are managed explicitly, claims must lock the database before reading.
+        # The connection is shared by threads (e.g. Classifier.prefetch_batches claims while loading)
+        self._connection = sqlite3.connect(self.db_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._connection.execute(WorkQueue.SCHEMA)
+        self._lock = threading.Lock()
+
+    def _key(self, item):
+        return os.path.relpath(str(item), self.root) if self.root is not None else str(item)
+
+    def _path(self, key):
+        return os.path.join(self.root, key) if self.root is not None else key
+
+    def enqueue(self, items):
+        """
+        Add items to the queue, e.g. images still to process according to the manifest or every image of a forced run.
+        Items done, failed or released before this queue was opened are pending again, items pending,
+        leased or finished since (by other workers) are left untouched.
+        :param items: list of items, e.g. images file paths
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            self._connection.executemany("INSERT INTO tasks (stage, item, status, updated) "
+                                         "VALUES (?, ?, 'pending', ?) "
+                                         "ON CONFLICT (stage, item) DO UPDATE SET status = 'pending', owner = NULL, "
+                                         "lease_expires = NULL, attempts = 0, error = NULL, updated = excluded.updated "
+                                         "WHERE status IN ('done', 'failed', 'released') AND updated < ?",
+                                         [(self.stage, self._key(item), now, self._opened) for item in items])
+            self._connection.execute("COMMIT")
+
+    def claim(self, count=1):
+        """
+        Lease up to count pending items, or items whose lease expired.
+        :param count: max number of items to claim
+        :return: list of claimed items, empty when there is nothing left to claim
+        """
+        now = time.time()
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock before reading, two workers can't claim the same items
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._connection.execute("SELECT item FROM tasks WHERE stage = ? AND "
+                                                "(status = 'pending' OR (status = 'leased' AND lease_expires < ?)) "
+                                                "ORDER BY item LIMIT ?", (self.stage, now, count)).fetchall()
+                keys = [row[0] for row in rows]
+                self._connection.executemany("UPDATE tasks SET status = 'leased', owner = ?, lease_expires = ?, "
+                                             "attempts = attempts + 1, updated = ? WHERE stage = ? AND item = ?",
+                                             [(self.worker_id, now + self.lease_time, now, self.stage, key)
+                                              for key in keys])
+                self._connection.execute("COMMIT")
+            except sqlite3.Error:
+                self._connection.execute("ROLLBACK")
+                raise
+
+        return [self._path(key) for key in keys]
+
+    def claimed_chunks(self, chunk_size):
+        """
+        Claim items in chunks until the queue is drained.
+        :param chunk_size: max number of items of each chunk
+        :return: generator of lists of claimed items, each chunk is claimed when the previous one was consumed
+        """
+        while True:
+            items = self.claim(chunk_size)
+            if not items:
+                return
+            yield items
+
+    def iter_claimed(self, chunk_size):
+        """
+        Claim items in chunks until the queue is drained, yielding them one at a time.
+        :param chunk_size: max number of items claimed at once
+        :return: generator of claimed items
+        """
+        for items in self.claimed_chunks(chunk_size):
+            for item in items:
+                yield item
+
+    def _finish(self, item, status, error=None):
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            cursor = self._connection.execute("UPDATE tasks SET status = ?, error = ?, lease_expires = NULL, "
+                                              "updated = ? WHERE stage = ? AND item = ? AND owner = ? "
+                                              "AND status = 'leased'",
+                                              (status, error, now, self.stage, self._key(item), self.worker_id))
+            finished = cursor.rowcount == 1
+            # heartbeat, the worker is alive: renew leases of its other claimed items
+            self._connection.execute("UPDATE tasks SET lease_expires = ? WHERE stage = ? AND owner = ? "
+                                     "AND status = 'leased'", (now + self.lease_time, self.stage, self.worker_id))
+            self._connection.execute("COMMIT")
+        return finished
+
+    def complete(self, item):
+        """
+        Record an item as done.
+        :return: False if the lease expired and the item was claimed by another worker
+        """
+        return self._finish(item, "done")
+
+    def release(self, item, reason=None):
+        """
+        Record an item left pending by its stage, e.g. a field rejected by the quality gate: it is not claimed again
+        by this run, the next run enqueuing it processes it again.
+        :param reason: optional reason, recorded as error
+        :return: False if the lease expired and the item was claimed by another worker
+        """
+        return self._finish(item, "released", reason)
+
+    def fail(self, item, error):
+        """
+        Record an item failure, the item is claimed again until it fails max_attempts times.
+        :return: False if the lease expired and the item was claimed by another worker
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT attempts FROM tasks WHERE stage = ? AND item = ?",
+                                           (self.stage, self._key(item))).fetchone()
+        status = "failed" if row is not None and row[0] >= self.max_attempts else "pending"
+        return self._finish(item, status, str(error))
+
+    def counts(self):
+        """
+        :return: dict of status: number of items of this stage
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT status, COUNT(*) FROM tasks WHERE stage = ? GROUP BY status",
+                                            (self.stage,))
+            return dict(rows.fetchall())
+
+    def close(self):
+        self._connection.close()
@@ -1,8 +1,13 @@
 import numpy as np
-import skimage.measure as skimeasure
 import scipy as sci
+import scipy.spatial
+from src.processing.label_ops import region_stats
 
 
+HULL_MIN_POINTS = 64  # below this number of centroids the full distance matrix is cheaper than the convex hull
+# scipy.spatial.qhull namespace is deprecated in recent scipy versions, that export QhullError from scipy.spatial
+QHULL_ERROR = getattr(sci.spatial, "QhullError", None) or sci.spatial.qhull.QhullError
+
 
 def density(bin_img):
     bins = np.bincount(bin_img.ravel())
@@ -11,29 +16,61 @@ def density(bin_img):
     return bins[-1] / npixels  # for sparsity return 1-density
 
 
+def farthest_distances(points):
+    # distance of each point from the farthest one, the farthest point is always a convex hull vertex
+    # so only distances from hull vertices are computed instead of the full n x n matrix
+    candidates = points
+    if len(points) >= HULL_MIN_POINTS:
+        try:
+            hull = sci.spatial.ConvexHull(points)
+            candidates = points[hull.vertices]
+        except QHULL_ERROR:  # degenerate set, e.g. collinear points
+            pass
+
+    return sci.spatial.distance.cdist(points, candidates).max(axis=1)
 
 
 def clusterness(labels):
-    regions = skimeasure.regionprops(labels)
     npixels = labels.shape[0] * labels.shape[1]  # number of image pixels
 
-    centroids = [region.centroid for region in regions]
-    dist_matrix = sci.spatial.distance_matrix(centroids, centroids)
-    summ = 0
-    total_area = 0
-
-    for region in regions:
-        dist = dist_matrix[region.label - 1].max() - dist_matrix[region.label - 1].min()
-        coeff = ((region.area / npixels) * dist)
-        summ += coeff
-        total_area += (region.area / npixels)
-        """print("id: {}, area: {}, avg dist: {}, coeff: {} ,centroid: {}".format(region.label, 
-                                                                               region.area, 
-                                                                               dist,
-                                                                               coeff,
-                                                                               region.centroid))"""
-    nclusters = len(regions)
+    regions = region_stats(labels)
+    areas, centroids = regions.areas, regions.centroids
+    nclusters = len(regions.ids)
+    if nclusters == 0:
+        return 0.0, 0, 0.0
+
+    # max - min of a distance matrix row, the min is the distance of a centroid from itself.
+    # Centroids are aligned with areas, so labels are not required to be sequential
+    dist = farthest_distances(centroids)
+
+    relative_areas = areas / npixels
+    summ = np.sum(relative_areas * dist)
+    total_area = np.sum(relative_areas)
+
     clusterness = summ / (np.log2(nclusters) + 1)
 
     return clusterness, nclusters, total_area
 
+
+def adjacent_pairs(labels):
+    # unique (u, v) pairs, u < v, of different regions touching with 8-connectivity, background excluded.
+    # Same edges of skimage RAG(labels, connectivity=2), without building the graph
+    nlabels = np.int64(labels.max()) + 1
+    keys = []
+    for a, b in ((labels[:, :-1], labels[:, 1:]), (labels[:-1, :], labels[1:, :]),
+                 (labels[:-1, :-1], labels[1:, 1:]), (labels[:-1, 1:], labels[1:, :-1])):
+        mask = (a != b) & (a != 0) & (b != 0)
+        u, v = a[mask].astype(np.int64), b[mask].astype(np.int64)
+        keys.append(np.minimum(u, v) * nlabels + np.maximum(u, v))
+
+    keys = np.unique(np.concatenate(keys))
+    return np.column_stack((keys // nlabels, keys % nlabels))
+
+
+def agglomeration(labels):
+    nregions = np.count_nonzero(np.bincount(labels.ravel())[1:])
+    if nregions == 0:
+        return 0.0
+
+    # edges / (2 * nodes) of the region adjacency graph
+    return len(adjacent_pairs(labels)) / (2 * nregions)
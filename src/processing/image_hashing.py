@@ -0,0 +1,56 @@
+import hashlib
+
+import numpy as np
+import cv2 as cv2
+
+from src.processing.quality import downsample
+
+
+def dhash(image, hash_size=8):
+    """
+    Compute the difference hash of an image: the sign of horizontal gradients of a tiny gray copy.
+    Resized, re-encoded or slightly shifted copies of an image have equal or close (in Hamming distance) hashes.
+
+    :param image: a numpy ndarray (or memmap) instance of a 3 channel RGB image, uint8 or float
+    :param hash_size: side of the gradients grid, the hash has hash_size ** 2 bits
+    :return: hash as python int
+    """
+    small = downsample(image, max_side=16 * hash_size)  # avoid reading a whole memory mapped image
+    gray = cv2.cvtColor(small.astype(np.float32), cv2.COLOR_RGB2GRAY)
+    tiny = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+
+    bits = (tiny[:, 1:] > tiny[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count("1")
+
+
+def digest(image):
+    """
+    :param image: a numpy ndarray (or memmap) instance of an image
+    :return: hex SHA-1 digest of image shape, dtype and pixels, equal only for identical images
+    """
+    image = np.ascontiguousarray(image)
+    content = hashlib.sha1("{}{}".format(image.shape, image.dtype).encode())
+    content.update(image.data)
+    return content.hexdigest()
+
+
+def pixel_mse(image_a, image_b, max_side=256):
+    """
+    Mean squared difference of gray levels of downsampled copies of two images, to confirm that images with
+    close hashes are really the same content.
+
+    :param image_a: a numpy ndarray (or memmap) instance of a 3 channel RGB image
+    :param image_b: a numpy ndarray (or memmap) instance of a 3 channel RGB image, resized to image_a size if needed
+    :param max_side: side of the downsampled copies
+    :return: mean squared difference, in squared gray levels of image_a dtype
+    """
+    gray_a = cv2.cvtColor(downsample(image_a, max_side).astype(np.float32), cv2.COLOR_RGB2GRAY)
+    gray_b = cv2.cvtColor(downsample(image_b, max_side).astype(np.float32), cv2.COLOR_RGB2GRAY)
+    if gray_b.shape != gray_a.shape:
+        gray_b = cv2.resize(gray_b, (gray_a.shape[1], gray_a.shape[0]), interpolation=cv2.INTER_AREA)
+
+    return float(np.mean((gray_a - gray_b) ** 2))
@@ -1,7 +1,9 @@
 import numpy as np
+import scipy.ndimage as ndimage
 import skimage.morphology as skimorph
-import skimage.measure as skimeasure
+import skimage.feature as skifeature
 import cv2 as cv2
+from src.processing.label_ops import filter_by_area
 
 
 def binarization(img):
@@ -14,15 +16,19 @@ def binarization(img):
 
 
 def filter_labels(labels, min_area=500, max_area=None):
-    filtered = labels.copy()
+    # labels are expected connected regions (e.g. watershed or measure.label output),
+    # remaining ids are made sequential by the lookup table, no need to label again
+    return filter_by_area(labels, min_area, max_area or None)
 
-    min_area_mask = np.bincount(labels.ravel()) < min_area  # get area for each label and filter
-    mask = min_area_mask[filtered]
-    filtered[mask] = 0  # set as background label
 
-    if max_area:
-        max_area_mask = np.bincount(labels.ravel()) > max_area  # get area for each label and filter
-        mask = max_area_mask[filtered]
-        filtered[mask] = 0
+def watershed_segmentation(binary, min_distance=25):
+    # split touching cells of a binarized image with watershed on the distance map
+    dist_map = ndimage.distance_transform_edt(binary)
+    local_max = skifeature.peak_local_max(dist_map, indices=False, min_distance=min_distance, labels=binary)
 
-    return skimeasure.label(filtered)  ## recompute labels to restart ids
+    # perform a connected component analysis on the local peaks,
+    # using 8-connectivity, then apply the Watershed algorithm
+    markers = ndimage.label(local_max, structure=np.ones((3, 3)))[0]
+    labels = skimorph.watershed(-dist_map, markers, mask=binary)
+
+    return filter_labels(labels)
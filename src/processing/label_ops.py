@@ -0,0 +1,113 @@
+import numpy as np
+from scipy import ndimage
+from collections import namedtuple
+
+Regions = namedtuple("Regions", ["ids", "areas", "bboxes", "centroids"])
+
+
+def region_stats(labels, centroids=True):
+    """
+    Compute area, bounding box and centroid of every region of a labels image, in C level scans
+    instead of building a regionprops object for each region.
+
+    Regions are sorted by label, as regionprops does. Bounding boxes are (min row, min col, max row, max col)
+    with max coordinates excluded, as regionprops bbox.
+
+    :param labels: a numpy ndarray instance of non negative integer labels, 0 is background
+    :param centroids: if False centroids are not computed (they need per pixel coordinates)
+    :return: Regions namedtuple of ids (n,), areas (n,), bboxes (n, 4) and centroids (n, 2) or None
+    """
+    flat = labels.ravel()
+    areas = np.bincount(flat)
+
+    ids, bboxes = region_bboxes(labels, max_label=len(areas) - 1)
+
+    region_centroids = None
+    if centroids:
+        rows, cols = np.indices(labels.shape)
+        rows_sum = np.bincount(flat, weights=rows.ravel(), minlength=len(areas))
+        cols_sum = np.bincount(flat, weights=cols.ravel(), minlength=len(areas))
+        region_centroids = np.column_stack((rows_sum[ids] / areas[ids], cols_sum[ids] / areas[ids]))
+
+    return Regions(ids=ids, areas=areas[ids], bboxes=bboxes, centroids=region_centroids)
+
+
+def region_bboxes(labels, max_label=None):
+    """
+    Compute only ids and bounding boxes of regions of a labels image, with a single scan that doesn't copy
+    the labels, so memory doesn't depend on image size (e.g. for memory mapped labels of large fields).
+
+    :param labels: a numpy ndarray (or memmap) instance of non negative integer labels, 0 is background
+    :param max_label: max label value, computed if None
+    :return: tuple of ids (n,) sorted by label and bboxes (n, 4), as region_stats
+    """
+    slices = ndimage.find_objects(labels, max_label=max_label or 0)
+    ids = np.array([label for label, region in enumerate(slices, start=1) if region is not None], dtype=np.intp)
+    bboxes = np.array([(region[0].start, region[1].start, region[0].stop, region[1].stop)
+                       for region in slices if region is not None], dtype=np.intp).reshape(-1, 4)
+
+    return ids, bboxes
+
+
+def compact_label_dtype(nlabels):
+    """
+    :param nlabels: max label value
+    :return: smallest unsigned integer dtype able to store labels up to nlabels
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if nlabels <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def filter_by_area(labels, min_area=None, max_area=None, areas=None, out=None, chunk_rows=None, compact=False):
+    """
+    Remove regions with area out of [min_area, max_area] and relabel the remaining ones
+    with sequential ids, applying a single lookup table to the labels image.
+
+    Ids order is preserved, so the i-th remaining region keeps its position among regions.
+
+    :param labels: a numpy ndarray instance of non negative integer labels, 0 is background
+    :param min_area: regions with smaller area are removed, if None no lower limit
+    :param max_area: regions with bigger area are removed, if None no upper limit
+    :param areas: areas of every label (np.bincount of labels), computed if None
+    :param out: optional ndarray where filtered labels are written, it can be labels itself (in place filter)
+    or an array of a smaller dtype able to store the remaining regions number
+    :param chunk_rows: if not None areas are counted and the lookup table is applied in blocks of this number
+    of rows, so temporary memory doesn't depend on image size
+    :param compact: if True and out is None, filtered labels are written in a new array of the smallest dtype
+    able to store the remaining regions number, see compact_label_dtype
+    :return: filtered labels ndarray, with the same dtype of labels or out, or the compact dtype
+    """
+    if areas is None and chunk_rows is None:
+        areas = np.bincount(labels.ravel())
+    elif areas is None:
+        # bincount copies labels as intp, count blocks of rows to bound the copy
+        areas = np.zeros(int(labels.max()) + 1, dtype=np.intp)
+        for start in range(0, len(labels), chunk_rows):
+            areas += np.bincount(labels[start:start + chunk_rows].ravel(), minlength=len(areas))
+
+    keep = areas > 0
+    keep[0] = False  # background
+    if min_area is not None:
+        keep &= areas >= min_area
+    if max_area is not None:
+        keep &= areas <= max_area
+
+    nkept = np.count_nonzero(keep)
+    if out is None and compact:
+        out = np.empty(labels.shape, dtype=compact_label_dtype(nkept))
+
+    lut = np.zeros(len(areas), dtype=labels.dtype if out is None else out.dtype)
+    lut[keep] = np.arange(1, nkept + 1)
+
+    if out is None and chunk_rows is None:
+        return lut[labels]
+
+    if out is None:
+        out = np.empty_like(labels)
+    step = chunk_rows or len(labels)
+    for start in range(0, len(labels), step):
+        out[start:start + step] = lut[labels[start:start + step]]
+
+    return out
@@ -0,0 +1,42 @@
+import numpy as np
+import cv2 as cv2
+from collections import namedtuple
+
+QualityMetrics = namedtuple("QualityMetrics", ["contrast", "foreground", "focus", "saturated"])
+
+
+def downsample(image, max_side=512):
+    # decimate first, so memory mapped images are not read in full, then average pixels blocks
+    side = max(image.shape[:2])
+    step = max(1, side // (2 * max_side))
+    small = np.ascontiguousarray(image[::step, ::step, :3])
+
+    scale = max_side / max(small.shape[:2])
+    if scale < 1:
+        small = cv2.resize(small, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    return small
+
+
+def quality_metrics(image, max_side=512):
+    """
+    Compute cheap field quality metrics on a downsampled copy of an RGB field image.
+
+    * contrast: standard deviation of gray levels, near 0 for blank fields
+    * foreground: fraction of pixels darker than Otsu threshold, the feature_extraction.density of the thresholded copy
+    * focus: variance of the gray levels laplacian, low for out of focus fields
+    * saturated: fraction of pixels with a clipped (0 or 255) gray level
+
+    :param image: a numpy ndarray (or memmap) instance of a 3 channel RGB image
+    :param max_side: side of the downsampled copy
+    :return: QualityMetrics namedtuple
+    """
+    gray = cv2.cvtColor(downsample(image, max_side), cv2.COLOR_RGB2GRAY)
+
+    binary = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
+    saturated = np.count_nonzero((gray == 0) | (gray == 255)) / gray.size
+
+    return QualityMetrics(contrast=float(gray.std()),
+                          foreground=np.count_nonzero(binary) / binary.size,
+                          focus=float(cv2.Laplacian(gray, cv2.CV_64F).var()),
+                          saturated=float(saturated))
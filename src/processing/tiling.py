@@ -0,0 +1,63 @@
+import tempfile
+from pathlib import Path
+from collections import namedtuple
+
+import numpy as np
+from skimage import io
+
+Tile = namedtuple("Tile", ["core", "extended"])
+
+
+def tile_grid(shape, tile_size, overlap):
+    """
+    Split an image in a grid of non overlapping core tiles, each one extended by an overlap margin.
+
+    Boxes are (min row, min col, max row, max col) tuples, max coordinates are excluded.
+
+    :param shape: image shape
+    :param tile_size: side of core tiles
+    :param overlap: margin added to each side of the core tile, clipped to image borders
+    :return: generator of Tile namedtuple
+    """
+    height, width = shape[:2]
+    for minr in range(0, height, tile_size):
+        for minc in range(0, width, tile_size):
+            maxr = min(minr + tile_size, height)
+            maxc = min(minc + tile_size, width)
+            extended = (max(minr - overlap, 0), max(minc - overlap, 0),
+                        min(maxr + overlap, height), min(maxc + overlap, width))
+            yield Tile(core=(minr, minc, maxr, maxc), extended=extended)
+
+
+def open_image_memmap(img_path, tmp_dir=None):
+    """
+    Open an image as a memory mapped ndarray.
+
+    .npy files are mapped directly, other formats are decoded once and copied in
+    an anonymous temporary file, so later reads don't keep the full image in memory.
+
+    :param img_path: image file path
+    :param tmp_dir: directory of the temporary file, system default if None
+    :return: a numpy memmap instance
+    """
+    img_path = Path(img_path)
+    if img_path.suffix == ".npy":
+        return np.load(str(img_path), mmap_mode="r")
+
+    img = io.imread(str(img_path))
+    mapped = np.memmap(tempfile.TemporaryFile(dir=tmp_dir), dtype=img.dtype, mode="w+", shape=img.shape)
+    mapped[:] = img
+    mapped.flush()
+
+    return mapped
+
+
+def empty_labels_memmap(shape, dtype=np.int32):
+    """
+    Allocate a zero filled labels ndarray backed by an anonymous temporary file.
+
+    :param shape: labels shape
+    :param dtype: labels dtype
+    :return: a numpy memmap instance
+    """
+    return np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode="w+", shape=shape)
@@ -1,55 +1,109 @@
-from pathlib import Path
-import random as rnd
+import os
+import heapq
 import shutil
+import hashlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 
 class Sampler:
+    """
+    Sample image files from a dataset directory, equally from each class sub-directory unless is_flat.
+
+    Sampling scans each directory once, streaming its entries: every file gets a pseudo random key from
+    the seed and its path and the files with the smallest keys are kept (bottom-k sampling), so memory
+    depends on the sample size only and samples don't depend on directory listing order.
+    """
 
-    def __init__(self,  in_dir,  is_flat=False, extension="png",seed=420):
+    def __init__(self,  in_dir,  is_flat=False, extension="png", seed=420, copy_workers=8):
 
-        rnd.seed(seed)
+        self.seed = seed
 
         self.in_dir = Path(in_dir)
 
         self.is_flat = is_flat
         self.extension = extension
+        self.copy_workers = copy_workers
 
         self.samples = []
+        self._dataset_size = None
+
+    def _key(self, path):
+        digest = hashlib.md5("{}:{}".format(self.seed, os.path.relpath(path, str(self.in_dir))).encode()).digest()
+        return int.from_bytes(digest[:8], "big") / 2 ** 64  # uniform in [0, 1)
+
+    def _iter_files(self, directory, recursive=False):
+        suffix = "." + self.extension
+        with os.scandir(str(directory)) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(suffix):
+                    yield entry.path
+                elif recursive and entry.is_dir():
+                    yield from self._iter_files(entry.path, recursive)
 
     def get_dataset_size(self):
-        return len(list(self.in_dir.glob("**/*.{}".format(self.extension))))
+        if self._dataset_size is None:
+            self._dataset_size = sum(1 for _ in self._iter_files(self.in_dir, recursive=True))
+        return self._dataset_size
+
+    def _sample_directory(self, directory, k=None, probability=None):
+        # keep the k files with smallest keys, or every file with key below probability
+        heap = []  # max-heap of (-key, path) of size k
+        count = 0
+        for path in self._iter_files(directory):
+            count += 1
+            key = self._key(path)
+            if probability is not None:
+                if key < probability:
+                    heap.append((-key, path))
+            elif k == 0:
+                continue  # empty sample, e.g. more folders than samples, files are only counted
+            elif len(heap) < k:
+                heapq.heappush(heap, (-key, path))
+            elif -heap[0][0] > key:
+                heapq.heapreplace(heap, (-key, path))
+
+        return [Path(path) for _, path in sorted(heap, reverse=True)], count
 
     def sampling(self, sample_size=10, percent=None):
-        if percent:
-            k = int((percent / self.get_dataset_size()) * 100)
-        else:
-            k = sample_size
-
-        if sample_size > self.get_dataset_size():
-            raise ValueError("Not enough samples to sample, lower the sample size")
+        """
+        :param sample_size: number of files to sample
+        :param percent: if not None each file is sampled with percent / 100 probability, instead of sampling
+        a fixed number of files
+        :return: list of sampled files paths
+        """
+        probability = percent / 100 if percent else None
+        k = sample_size
 
         if not self.is_flat:
-            dirs = [dir for dir in self.in_dir.glob("*") if dir.is_dir()]
+            dirs = sorted(entry.path for entry in os.scandir(str(self.in_dir)) if entry.is_dir())
             k = k // len(dirs)  # sampling equally in each folder
-
-            for dir in dirs:
-                files = list(dir.glob("*.{}".format(self.extension)))
-                if k > len(files):
-                    self.samples.extend(rnd.sample(files, len(files)))
-                else:
-                    self.samples.extend(rnd.sample(files, k))
         else:
-            files = list(self.in_dir.glob("*.{}".format(self.extension)))
-            self.samples.extend(rnd.sample(files, k))
+            dirs = [str(self.in_dir)]
 
-        return [str(file) for file in self.samples]
+        samples = []
+        size = 0
+        for dir in dirs:
+            files, count = self._sample_directory(dir, k, probability)
+            samples.extend(files)
+            size += count
+
+        if percent is None and sample_size > size:
+            raise ValueError("Not enough samples to sample, lower the sample size")
+
+        self.samples.extend(samples)
+        return [str(file) for file in samples]
 
     def create_dataset_from_sample(self, out_dir):
         out_dir = Path(out_dir)
         out_dir.mkdir()
 
-        for i, file in enumerate(self.samples):
-            shutil.copy(file,  out_dir / "{}-.png".format(i + 1))
+        def copy(indexed_file):
+            i, file = indexed_file
+            shutil.copy(str(file), str(out_dir / "{}-.png".format(i + 1)))
+
+        with ThreadPoolExecutor(self.copy_workers) as executor:
+            list(executor.map(copy, enumerate(self.samples)))  # consume results to raise copy errors
 
 
 class LatexDoc:
@@ -0,0 +1,75 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+from skimage import morphology
+
+from src.core.cell_extractor import (Extractor, size_filter_stage, LOW_MEMORY_CHUNK_ROWS, LOW_THRESHOLD_SIZE,
+                                     HIGH_THRESHOLD_SIZE)
+from src.processing.label_ops import compact_label_dtype
+
+BACKGROUND_COLOR = (225, 218, 230)
+CELL_COLOR = (150, 95, 165)
+
+
+def peak_memory(function):
+    # peak of numpy allocations traced while running function, and its result
+    tracemalloc.start()
+    try:
+        result = function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def watershed_like_labels(shape=(2048, 2048), block=160, seed=0):
+    # one rectangle for each block, with areas below, between and above size thresholds
+    rng = np.random.RandomState(seed)
+    labels = np.zeros(shape, dtype=np.int32)
+    label = 1
+    for top in range(0, shape[0] - block + 1, block):
+        for left in range(0, shape[1] - block + 1, block):
+            height, width = rng.randint(20, block, size=2)
+            labels[top:top + height, left:left + width] = label
+            label += 1
+    return labels
+
+
+def synthetic_field(shape=(768, 768), ncells=40, seed=0):
+    rng = np.random.RandomState(seed)
+    image = np.empty(shape + (3,), dtype=np.uint8)
+    image[:] = BACKGROUND_COLOR
+    rows, cols = np.ogrid[:shape[0], :shape[1]]
+    for _ in range(ncells):
+        radius = rng.randint(25, 55)
+        row, col = rng.randint(radius, shape[0] - radius), rng.randint(radius, shape[1] - radius)
+        image[(rows - row) ** 2 + (cols - col) ** 2 <= radius ** 2] = CELL_COLOR
+    return image
+
+
+def test_compact_size_filter_matches_and_lowers_peak():
+    labels = watershed_like_labels()
+    reference, reference_peak = peak_memory(lambda: size_filter_stage(labels))
+
+    filtered, peak = peak_memory(lambda: size_filter_stage(labels, chunk_rows=LOW_MEMORY_CHUNK_ROWS, compact=True))
+
+    assert filtered.dtype == compact_label_dtype(reference.max()) == np.uint8
+    assert np.array_equal(filtered, reference)
+    assert 0 < reference.max() < labels.max()  # some regions are removed
+    assert np.bincount(filtered.ravel())[1:].min() >= LOW_THRESHOLD_SIZE
+    assert np.bincount(filtered.ravel())[1:].max() <= HIGH_THRESHOLD_SIZE
+    assert filtered.nbytes == labels.nbytes / 4
+    assert peak < reference_peak / 4
+
+
+@pytest.mark.skipif(not hasattr(morphology, "watershed"),
+                    reason="detect_cells needs the skimage version of requirements.txt")
+def test_detect_cells_low_memory_matches_and_lowers_peak():
+    image = synthetic_field()
+    (labels, _), peak = peak_memory(lambda: Extractor.detect_cells(image))
+    (low_memory_labels, _), low_memory_peak = peak_memory(lambda: Extractor.detect_cells(image, low_memory=True))
+
+    assert np.array_equal(low_memory_labels, labels)
+    assert low_memory_labels.dtype == compact_label_dtype(labels.max())
+    assert low_memory_peak < peak
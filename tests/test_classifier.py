@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from src.core.classifier import Classifier
+
+# max differences, in [0, 1] intensity units, of OpenCV resized cells from the training transformation
+FAST_MAX_DIFFERENCE = 0.02
+FAST_MEAN_DIFFERENCE = 0.003
+# smaller and bigger than model input
+CROP_SHAPES = [(30, 30), (40, 45), (50, 50), (64, 58), (80, 60), (100, 100)]
+
+
+def cell_crops(shapes, seed=0):
+    # smooth random RGB crops, like cells crops with no sharp texture
+    rng = np.random.RandomState(seed)
+    return [ndimage.gaussian_filter(rng.randint(0, 256, shape + (3,)).astype(np.float64), (3, 3, 0)).astype(np.uint8)
+            for shape in shapes]
+
+
+def test_pre_process_batch_default_matches_pre_process_array():
+    crops = cell_crops(CROP_SHAPES)
+
+    reference = np.concatenate([Classifier.pre_process_array(crop) for crop in crops])
+
+    assert np.array_equal(Classifier.pre_process_batch(crops), reference)
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_fast_pre_process_batch_difference_is_bounded(seed):
+    crops = cell_crops(CROP_SHAPES, seed)
+
+    difference = np.abs(Classifier.pre_process_batch(crops, fast=True) -
+                        np.concatenate([Classifier.pre_process_array(crop) for crop in crops]))
+
+    assert difference.max() <= FAST_MAX_DIFFERENCE
+    assert difference.mean() <= FAST_MEAN_DIFFERENCE
+
+
+def test_pre_process_batch_fills_preallocated_batch():
+    crops = cell_crops(CROP_SHAPES)
+    out = np.empty((len(crops) + 2, Classifier.INPUT_IMAGE_WIDTH, Classifier.INPUT_IMAGE_HEIGHT, 3),
+                   dtype=np.float32)
+
+    batch = Classifier.pre_process_batch(crops, out=out, fast=True)
+
+    assert batch.shape == (len(crops), Classifier.INPUT_IMAGE_WIDTH, Classifier.INPUT_IMAGE_HEIGHT, 3)
+    assert np.shares_memory(batch, out)
@@ -0,0 +1,52 @@
+import numpy as np
+
+from src.core.dedup_index import DedupIndex, find_duplicate
+from src.processing.image_hashing import dhash, digest
+
+
+def random_images(n, shape=(40, 40, 3), seed=0):
+    rng = np.random.RandomState(seed)
+    return [rng.randint(0, 256, shape).astype(np.uint8) for _ in range(n)]
+
+
+def test_identical_images_are_exact_duplicates(tmp_path):
+    index = DedupIndex(tmp_path / "dedup.sqlite")
+    image, other = random_images(2)
+
+    assert index.check("cells", "f_cell#0.png", image) == (None, 0)
+    assert index.check("cells", "f_cell#1.png", image.copy()) == ("f_cell#0.png", 0)
+    assert index.check("cells", "f_cell#2.png", other) == (None, 0)
+
+
+def test_changed_image_of_indexed_path_is_indexed_again(tmp_path):
+    index = DedupIndex(tmp_path / "dedup.sqlite")
+    image, other = random_images(2)
+    index.check("cells", "f_cell#0.png", image)
+    index.check("cells", "f_cell#1.png", image.copy())
+    index.set_value("cells", "f_cell#1.png", {"class": 1})
+
+    assert index.check("cells", "f_cell#1.png", other) == (None, 0)
+    assert index.value("cells", "f_cell#1.png") is None
+
+    # aliases of a changed canonical image are checked again against the current images
+    assert index.check("cells", "f_cell#0.png", other) == ("f_cell#1.png", 0)
+    assert index.check("cells", "f_cell#2.png", image) == (None, 0)
+
+
+def test_find_duplicate_in_tree_copy_matches_check(tmp_path):
+    index = DedupIndex(tmp_path / "dedup.sqlite")
+    image, other = random_images(2)
+    index.check("fields", "a.png", image)
+    index.check("fields", "b.png", other)
+    tree = index.tree("fields")
+
+    def find(path, field_image):
+        return find_duplicate(tree, dhash(field_image), digest(field_image), index.max_distance, path=path)
+
+    assert find("c.png", image.copy()) == ("a.png", 0, True)
+    # indexed fields keep their outcome, changed ones are searched among the others
+    assert find("a.png", image) == (None, 0, False)
+    assert find("b.png", image) == ("a.png", 0, True)
+
+    hashes = (dhash(image), digest(image))
+    assert index.check("fields", "c.png", hashes=hashes) == index.check("fields", "d.png", image) == ("a.png", 0)
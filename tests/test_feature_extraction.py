@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+import scipy.spatial
+import skimage.measure as skimeasure
+
+from src.processing.feature_extraction import clusterness, HULL_MIN_POINTS
+
+
+def reference_clusterness(labels):
+    # previous regionprops and full distance matrix implementation, labels must be sequential
+    regions = skimeasure.regionprops(labels)
+    npixels = labels.shape[0] * labels.shape[1]
+
+    centroids = [region.centroid for region in regions]
+    dist_matrix = scipy.spatial.distance_matrix(centroids, centroids)
+    summ = 0
+    total_area = 0
+    for region in regions:
+        dist = dist_matrix[region.label - 1].max() - dist_matrix[region.label - 1].min()
+        summ += (region.area / npixels) * dist
+        total_area += region.area / npixels
+
+    nclusters = len(regions)
+    return summ / (np.log2(nclusters) + 1), nclusters, total_area
+
+
+def random_labels(nregions, seed, cell=12, collinear=False):
+    # one random rectangle of label 1..nregions in distinct cells of a grid
+    rng = np.random.RandomState(seed)
+    rows, cols = (1, nregions) if collinear else (int(np.ceil(np.sqrt(2 * nregions))),) * 2
+    labels = np.zeros((rows * cell, cols * cell), dtype=np.int32)
+
+    for label, index in enumerate(rng.choice(rows * cols, nregions, replace=False), start=1):
+        top, left = (index // cols) * cell, (index % cols) * cell
+        if collinear:
+            height, width, top_offset = 4, 4, 0  # centroids on the same row
+        else:
+            height, width = rng.randint(1, cell, size=2)
+            top_offset = rng.randint(0, cell - height + 1)
+        left_offset = rng.randint(0, cell - width + 1)
+        labels[top + top_offset:top + top_offset + height, left + left_offset:left + left_offset + width] = label
+
+    return labels
+
+
+@pytest.mark.parametrize("nregions", [1, 2, 5, HULL_MIN_POINTS - 1, HULL_MIN_POINTS, 3 * HULL_MIN_POINTS])
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_clusterness_matches_distance_matrix(nregions, seed):
+    labels = random_labels(nregions, seed)
+
+    assert np.allclose(clusterness(labels), reference_clusterness(labels))
+
+
+@pytest.mark.parametrize("nregions", [3, HULL_MIN_POINTS + 16])
+def test_clusterness_collinear_centroids(nregions):
+    labels = random_labels(nregions, seed=0, collinear=True)
+
+    assert np.allclose(clusterness(labels), reference_clusterness(labels))
+
+
+def test_clusterness_empty_labels():
+    assert clusterness(np.zeros((32, 32), dtype=np.int32)) == (0.0, 0, 0.0)
@@ -0,0 +1,47 @@
+import tracemalloc
+
+import numpy as np
+
+from src.core.cell_extractor import Extractor
+from src.processing.label_ops import region_stats, region_bboxes
+from src.processing.tiling import empty_labels_memmap
+
+
+def labels_memmap(shape=(2048, 2048), block=128, seed=0):
+    # one rectangle for each block, some blocks are left empty so labels are not sequential
+    rng = np.random.RandomState(seed)
+    labels = empty_labels_memmap(shape)
+    label = 0
+    for top in range(0, shape[0], block):
+        for left in range(0, shape[1], block):
+            label += 1
+            if rng.rand() < 0.2:
+                continue
+            height, width = rng.randint(10, block, size=2)
+            labels[top:top + height, left:left + width] = label
+    return labels
+
+
+def test_region_bboxes_matches_region_stats():
+    labels = labels_memmap()
+    regions = region_stats(labels, centroids=False)
+
+    ids, bboxes = region_bboxes(labels)
+
+    assert np.array_equal(ids, regions.ids)
+    assert np.array_equal(bboxes, regions.bboxes)
+
+
+def test_crop_cells_memory_does_not_depend_on_labels_size():
+    labels = labels_memmap()
+    field_image = np.zeros(labels.shape + (3,), dtype=np.uint8)
+
+    tracemalloc.start()
+    try:
+        crops = list(Extractor.crop_cells(field_image, labels))
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert [crop.label for crop in crops] == list(region_stats(labels, centroids=False).ids)
+    assert peak < labels.nbytes / 16
@@ -0,0 +1,34 @@
+import os
+
+from src.core.work_queue import WorkQueue
+
+
+def test_items_finished_by_a_previous_run_are_queued_again(tmp_path):
+    db_path = tmp_path / "work_queue.sqlite"
+    queue = WorkQueue(db_path, "extraction")
+    queue.enqueue(["a.png", "b.png", "c.png"])
+    assert queue.claim(3) == ["a.png", "b.png", "c.png"]
+    queue.complete("a.png")
+    queue.release("b.png", "blurry")
+
+    # released items are not claimed again by the same run
+    assert queue.claim(3) == []
+    assert queue.counts() == {"done": 1, "released": 1, "leased": 1}
+
+    next_run = WorkQueue(db_path, "extraction")
+    next_run.enqueue(["a.png", "b.png", "c.png"])
+    assert next_run.counts() == {"pending": 2, "leased": 1}
+    assert next_run.claim(3) == ["a.png", "b.png"]
+
+
+def test_items_are_shared_relative_to_root(tmp_path):
+    db_path = tmp_path / "work_queue.sqlite"
+    queue = WorkQueue(db_path, "extraction", root=os.path.join("mnt", "node1", "input"))
+    other = WorkQueue(db_path, "extraction", root=os.path.join("node2", "input"))
+
+    queue.enqueue([os.path.join("mnt", "node1", "input", "a.png")])
+    other.enqueue([os.path.join("node2", "input", "a.png")])
+
+    assert other.claim(2) == [os.path.join("node2", "input", "a.png")]
+    assert other.complete(os.path.join("node2", "input", "a.png"))
+    assert queue.counts() == {"done": 1}
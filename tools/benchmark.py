@@ -0,0 +1,333 @@
+"""
+Benchmark suite for cells extraction and classification hot paths.
+
+Synthetic microscope-like fields with a known number of cells are generated at several
+resolutions and densities, each hot path is timed and results are appended to a JSON lines
+file, so different runs (e.g. before and after a change) can be compared.
+
+The python interpreter must be called from the repository root directory, see README.
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import subprocess
+import tracemalloc
+import datetime as dt
+
+import numpy as np
+from skimage import draw, io
+import skimage.measure as skimeasure
+
+from src.core.cell_extractor import Extractor
+from src.core.classifier import Classifier
+from src.core.tflite_backend import TFLiteModel, export_tflite, compare_models
+from src.core.data_manager import DataManager
+from src.processing.image_processing import binarization, filter_labels
+from src.processing.feature_extraction import clusterness
+
+BACKGROUND_COLOR = (225, 218, 230)
+CELL_COLOR = (150, 95, 165)
+NUCLEUS_COLOR = (90, 40, 120)
+CELL_RADIUS_RANGE = (25, 55)
+
+
+def synthetic_field(shape, ncells, seed=0):
+    """
+    Generate a microscope-like field image with non overlapping elliptic cells on a noisy background.
+
+    :param shape: (rows, columns) of the image
+    :param ncells: number of cells to draw, less cells are drawn if they don't fit
+    :param seed: random generator seed
+    :return: tuple of uint8 RGB image and number of drawn cells
+    """
+    rng = np.random.RandomState(seed)
+    image = np.empty(shape + (3,), dtype=np.float32)
+    image[:] = BACKGROUND_COLOR
+    image += rng.normal(0, 6, image.shape)
+
+    centers = []
+    attempts = 0
+    while len(centers) < ncells and attempts < ncells * 50:
+        attempts += 1
+        radius = rng.randint(*CELL_RADIUS_RANGE)
+        r = rng.randint(radius, shape[0] - radius)
+        c = rng.randint(radius, shape[1] - radius)
+        if any((r - rr) ** 2 + (c - cc) ** 2 < (radius + rad + 10) ** 2 for rr, cc, rad in centers):
+            continue
+
+        centers.append((r, c, radius))
+        r_radius = radius * rng.uniform(0.8, 1.0)
+        rows, cols = draw.ellipse(r, c, r_radius, radius, shape=shape, rotation=rng.uniform(0, np.pi))
+        image[rows, cols] = CELL_COLOR + rng.normal(0, 8, (len(rows), 3))
+        rows, cols = draw.ellipse(r, c, r_radius / 2, radius / 2, shape=shape)
+        image[rows, cols] = NUCLEUS_COLOR
+
+    return np.clip(image, 0, 255).astype(np.uint8), len(centers)
+
+
+def stand_in_model(nclasses=7):
+    """
+    Build a small untrained convolutional network with the classifier input shape.
+
+    :param nclasses: number of output classes
+    :return: a compiled keras model
+    """
+    from keras.models import Sequential
+    from keras.layers import Conv2D, MaxPooling2D, Flatten, Dense
+
+    model = Sequential([
+        Conv2D(16, (3, 3), activation="relu",
+               input_shape=(Classifier.INPUT_IMAGE_WIDTH, Classifier.INPUT_IMAGE_HEIGHT, 3)),
+        MaxPooling2D(),
+        Conv2D(32, (3, 3), activation="relu"),
+        MaxPooling2D(),
+        Flatten(),
+        Dense(64, activation="relu"),
+        Dense(nclasses, activation="softmax")
+    ])
+    model.compile(optimizer="rmsprop", loss="categorical_crossentropy")
+    return model
+
+
+def measure(func, repeat):
+    """
+    Time a function and measure its peak traced memory.
+
+    Memory is measured on a separate call, so tracing overhead doesn't affect latencies.
+
+    :param func: function without arguments
+    :param repeat: number of timed calls
+    :return: tuple of latencies list in seconds and peak memory in bytes
+    """
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+
+    return latencies, peak
+
+
+def summary(case, params, items, latencies, peak):
+    latencies = np.asarray(latencies)
+    record = {"case": case}
+    record.update(params)
+    record.update({"items": items,
+                   "repeat": len(latencies),
+                   "latency_mean_ms": latencies.mean() * 1000,
+                   "latency_p50_ms": np.percentile(latencies, 50) * 1000,
+                   "latency_p90_ms": np.percentile(latencies, 90) * 1000,
+                   "latency_p99_ms": np.percentile(latencies, 99) * 1000,
+                   "throughput": items / latencies.mean(),
+                   "peak_memory_mb": peak / 1024 ** 2})
+    return record
+
+
+def run_extraction_cases(resolution, density, repeat, work_dir, seed):
+    shape = (resolution, resolution)
+    ncells = int(density * resolution * resolution / 1e6)
+    image, ncells = synthetic_field(shape, ncells, seed)
+    params = {"resolution": resolution, "density": density, "cells": ncells}
+
+    extractor = Extractor(DataManager(work_dir))
+    labels, steps = Extractor.detect_cells(image)
+    low_memory_labels, steps = Extractor.detect_cells(image, low_memory=True)
+    identical = {"identical_labels": bool(np.array_equal(labels, low_memory_labels))}
+    binary = binarization(image)
+    raw_labels = skimeasure.label(binary)
+    sequential_labels = filter_labels(raw_labels)
+    cells_dir = os.path.join(work_dir, "cells")
+    os.makedirs(cells_dir, exist_ok=True)
+
+    cases = [("detect_cells", 1, lambda: Extractor.detect_cells(image), {}),
+             ("detect_cells_low_memory", 1, lambda: Extractor.detect_cells(image, low_memory=True), identical),
+             ("extract_cells", ncells, lambda: extractor.extract_cells(image, labels, "bench", cells_dir), {}),
+             ("binarization", 1, lambda: binarization(image), {}),
+             ("filter_labels", 1, lambda: filter_labels(raw_labels), {}),
+             ("clusterness", 1, lambda: clusterness(sequential_labels), {})]
+
+    for case, items, func, case_params in cases:
+        latencies, peak = measure(func, repeat)
+        case_params = dict(params, **case_params)
+        yield summary(case, case_params, items, latencies, peak)
+
+
+def run_classification_cases(batch_sizes, ncells, repeat, work_dir, seed):
+    image, _ = synthetic_field((1024, 1024), 60, seed)
+    labels, steps = Extractor.detect_cells(image)
+    crops = [crop.image for crop in Extractor.crop_cells(image, labels)]
+    crops = [crops[i % len(crops)] for i in range(ncells)]
+
+    crop_files = []
+    for i, crop in enumerate(crops[:min(ncells, 100)]):
+        crop_file = os.path.join(work_dir, "crop{}.png".format(i))
+        io.imsave(crop_file, crop)
+        crop_files.append(crop_file)
+
+    def pre_process_files():
+        for crop_file in crop_files:
+            Classifier.pre_process_image(crop_file)
+
+    latencies, peak = measure(pre_process_files, repeat)
+    yield summary("pre_process_image", {}, len(crop_files), latencies, peak)
+
+    batch_crops = crops[:len(crop_files)]
+    reference = np.concatenate([Classifier.pre_process_array(crop) for crop in batch_crops])
+    max_difference = float(np.abs(Classifier.pre_process_batch(batch_crops, fast=True) - reference).max())
+    latencies, peak = measure(lambda: Classifier.pre_process_batch(batch_crops, fast=True), repeat)
+    yield summary("pre_process_batch", {"max_difference": max_difference}, len(batch_crops), latencies, peak)
+
+    model = stand_in_model()
+    images = [Classifier.pre_process_array(crop) for crop in crops]
+    backends = [("batched_classification", Classifier.from_model(model, DataManager(work_dir)), {})]
+    backends.extend(tflite_backends(model, Classifier.pre_process_batch(batch_crops), np.concatenate(images),
+                                    work_dir))
+
+    for case, classifier, params in backends:
+        for batch_size in batch_sizes:
+            def classify():
+                for batch, names in Classifier.iter_batches(images, images, batch_size):
+                    classifier.predict_batch(batch)
+
+            latencies, peak = measure(classify, repeat)
+            case_params = {"batch_size": batch_size}
+            case_params.update(params)
+            yield summary(case, case_params, ncells, latencies, peak)
+
+
+def tflite_backends(model, calibration_images, images, work_dir):
+    """
+    Convert a keras model in float and int8 TFLite artifacts and check their parity with the keras model.
+
+    :return: list of (case, classifier, parity params) tuples, empty if tensorflow is not installed
+    """
+    try:
+        import tensorflow
+    except ImportError:
+        print("tensorflow not installed, skip TFLite classification cases")
+        return []
+
+    backends = []
+    for case, calibration in (("tflite_classification", None), ("tflite_int8_classification", calibration_images)):
+        model_path = os.path.join(work_dir, "{}.tflite".format(case))
+        model_size = export_tflite(model, model_path, calibration)
+        tflite_model = TFLiteModel(model_path)
+        parity = compare_models(model, tflite_model, images, repeat=1)
+        backends.append((case, Classifier.from_model(tflite_model, DataManager(work_dir)),
+                         {"agreement": parity["agreement"],
+                          "max_difference": parity["max_probability_difference"],
+                          "model_size_kb": model_size / 1024}))
+
+    return backends
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_previous_run(outfile, run_id):
+    """
+    :return: dict of case key: record of the last run stored in outfile before run_id
+    """
+    if not os.path.exists(outfile):
+        return {}
+
+    runs = {}
+    timestamps = {}
+    with open(outfile) as file:
+        for line in file:
+            record = json.loads(line)
+            if record["run"] != run_id:
+                runs.setdefault(record["run"], {})[case_key(record)] = record
+                timestamps[record["run"]] = record["timestamp"]
+
+    if not runs:
+        return {}
+    return runs[max(timestamps, key=timestamps.get)]
+
+
+def case_key(record):
+    return (record["case"], record.get("resolution"), record.get("density"), record.get("batch_size"))
+
+
+def setup_parser():
+
+    parser = argparse.ArgumentParser(description="Benchmark cells extraction and classification hot paths")
+
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[512, 1024, 2048],
+                        help="Side in pixels of synthetic fields")
+    parser.add_argument("--densities", type=int, nargs="+", default=[10, 40, 80],
+                        help="Number of cells per megapixel of synthetic fields")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 32, 128],
+                        help="Batch sizes of batched classification")
+    parser.add_argument("--cells", type=int, default=512, help="Number of cells classified")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timed calls of each case")
+    parser.add_argument("--seed", type=int, default=1994, help="Synthetic fields random seed")
+    parser.add_argument("--skip-classifier", action="store_true", help="Don't run classification cases")
+    parser.add_argument("--outfile", default="benchmark_results.jsonl", help="Results file, new results are appended")
+    parser.add_argument("--compare", action="store_true", help="Compare results with the previous run in outfile")
+
+    return parser
+
+
+if __name__ == "__main__":
+
+    args = setup_parser().parse_args()
+
+    now = dt.datetime.now()
+    run_info = {"run": now.strftime("%Y%m%d-%H%M%S"),
+                "timestamp": now.isoformat(),
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpus": os.cpu_count()}
+
+    work_dir = tempfile.mkdtemp(prefix="rinocitologia-bench-")
+    records = []
+    try:
+        for resolution in args.resolutions:
+            for density in args.densities:
+                records.extend(run_extraction_cases(resolution, density, args.repeat, work_dir, args.seed))
+
+        if not args.skip_classifier:
+            records.extend(run_classification_cases(args.batch_sizes, args.cells, args.repeat, work_dir, args.seed))
+    finally:
+        shutil.rmtree(work_dir)
+
+    previous = load_previous_run(args.outfile, run_info["run"]) if args.compare else {}
+
+    with open(args.outfile, "a") as file:
+        for record in records:
+            record.update(run_info)
+            file.write(json.dumps(record) + "\n")
+
+            line = "{case:<24} res={res:<5} dens={dens:<4} bs={bs:<4} p50={p50:9.2f}ms p90={p90:9.2f}ms " \
+                   "thr={thr:9.2f}/s mem={mem:8.2f}MB".format(case=record["case"],
+                                                              res=str(record.get("resolution", "-")),
+                                                              dens=str(record.get("density", "-")),
+                                                              bs=str(record.get("batch_size", "-")),
+                                                              p50=record["latency_p50_ms"],
+                                                              p90=record["latency_p90_ms"],
+                                                              thr=record["throughput"],
+                                                              mem=record["peak_memory_mb"])
+            old = previous.get(case_key(record))
+            if old is not None:
+                line += " ({:+.1f}% p50 vs {})".format(
+                    (record["latency_p50_ms"] / old["latency_p50_ms"] - 1) * 100, old["run"])
+            print(line)
+
+    print("Results appended to {}".format(args.outfile))